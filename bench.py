@@ -0,0 +1,409 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+# ------------------------------------------------------------------
+# オフライン負荷テスト
+# Discord / Gemini / DuckDuckGo に繋がずに、本物のCogを偽物のInteractionで動かして測る。
+#   python bench.py                   # 全シナリオ
+#   python bench.py --scenario panel  # 募集パネルの8連打だけ
+#   python bench.py --json result.json
+# データは一時ディレクトリに作るので、data/ は汚さない。
+# ------------------------------------------------------------------
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+LAG_INTERVAL = 0.005
+
+def percentile(values, p):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summarize(values):
+    # 秒 → ms
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50) * 1000,
+        "p99": percentile(values, 99) * 1000,
+        "max": max(values, default=0.0) * 1000,
+    }
+
+
+# ---------------- 偽物のDiscord ----------------
+class FakeMessage:
+    counter = 0
+
+    def __init__(self, channel, content=None, **kwargs):
+        FakeMessage.counter += 1
+        self.id = FakeMessage.counter
+        self.channel = channel
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.edits += 1
+        self.edits += 1
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+
+class FakeChannel:
+    def __init__(self, channel_id, latency):
+        self.id = channel_id
+        self.latency = latency
+        self.sent = []
+        self.edits = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent.append(content)
+        return FakeMessage(self, content)
+
+    def get_partial_message(self, message_id):
+        message = FakeMessage(self)
+        message.id = message_id
+        return message
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def respond(self, kind):
+        if self.done: raise RuntimeError("This interaction has already been responded to before")
+        self.done = True
+        await asyncio.sleep(self.interaction.channel.latency)
+        self.interaction.responses.append(kind)
+        self.interaction.responded_at = time.perf_counter()
+
+    async def defer(self, **kwargs):
+        await self.respond("defer")
+
+    async def send_message(self, content=None, **kwargs):
+        await self.respond("send_message")
+
+    async def edit_message(self, **kwargs):
+        await self.respond("edit_message")
+        self.interaction.channel.edits += 1
+
+    async def send_modal(self, modal):
+        await self.respond("send_modal")
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, wait=False, **kwargs):
+        channel = self.interaction.channel
+        await asyncio.sleep(channel.latency)
+        if self.interaction.first_followup_at is None: self.interaction.first_followup_at = time.perf_counter()
+        self.interaction.followups.append(content)
+        return FakeMessage(channel, content)
+
+
+class FakeInteraction:
+    counter = 10 ** 15
+
+    def __init__(self, client, user_id, channel, message=None):
+        FakeInteraction.counter += 1
+        self.id = FakeInteraction.counter
+        self.client = client
+        self.user = SimpleNamespace(id=user_id, name=f"user{user_id}", display_name=f"ユーザー{user_id}")
+        self.channel = channel
+        self.channel_id = channel.id
+        self.message = message
+        self.guild = None
+        self.guild_id = None
+        self.data = {}
+        self.extras = {}
+        self.responses = []
+        self.followups = []
+        self.responded_at = None
+        self.first_followup_at = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# ---------------- 偽物のLLM / 検索 ----------------
+class StubChunk:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class StubProvider:
+    # generate はワーカースレッドで呼ばれるので、time.sleep で待つ（本物と同じくブロックする）
+    def __init__(self, latency, chunks):
+        self.latency = latency
+        self.chunks = chunks
+
+    def generate(self, model, contents, system_instruction=None, stream=False):
+        if not stream:
+            time.sleep(self.latency)
+            return StubChunk("これはテスト用の要約だよ！" * 10)
+        return self.stream()
+
+    def stream(self):
+        for i in range(self.chunks):
+            time.sleep(self.latency / self.chunks)
+            yield StubChunk(f"るーしーの返事その{i}だよ！" * 5)
+
+
+def stub_search(latency):
+    def fetch_one(text, region):
+        time.sleep(latency)
+        return [{"title": f"{text} {i}", "href": f"https://example.com/{abs(hash(text))}/{i}", "body": "FF14の攻略情報です。" * 20} for i in range(3)]
+    return fetch_one
+
+
+# ---------------- 計測 ----------------
+class LagSampler:
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - expected))
+
+    def __enter__(self):
+        self.samples = []
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+
+
+async def measure(name, scenario, results):
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    with LagSampler() as lag:
+        report = await scenario()
+    _, peak = tracemalloc.get_traced_memory()
+    report["wall_s"] = time.perf_counter() - started
+    report["loop_lag"] = summarize(lag.samples)
+    report["peak_alloc_mb"] = (peak - before) / 1024 / 1024
+    from startup import rss_mb
+    report["rss_mb"] = rss_mb()
+    results[name] = report
+    print_report(name, report)
+
+
+def print_report(name, report):
+    print(f"\n=== {name} ===  ({report['wall_s']:.2f}s, peak +{report['peak_alloc_mb']:.1f}MB, RSS {report['rss_mb']:.1f}MB)")
+    print(f"{'':<22}{'count':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for key, value in report.items():
+        if isinstance(value, dict) and "p50" in value:
+            print(f"{key:<22}{value['count']:>8}{value['p50']:>10.2f}{value['p99']:>10.2f}{value['max']:>10.2f}")
+    for key, value in report.items():
+        if not isinstance(value, dict) and key not in ("wall_s", "peak_alloc_mb", "rss_mb"):
+            print(f"{key:<22}{value}")
+
+
+# ---------------- シナリオ ----------------
+def panel_scenario(bot, args):
+    pf_module = sys.modules["cogs.partyfinder"]
+    cog = bot.get_cog("PartyFinder")
+    channel = FakeChannel(1, args.discord_latency)
+    bot.get_partial_messageable = lambda channel_id, **kwargs: channel
+
+    async def scenario():
+        clicks, settles = [], []
+        for burst in range(args.bursts):
+            data = {"type": "FULL", "author_id": 1, "author": "主催者", "my_role": "None", "content": f"ベンチ{burst}",
+                    "time": "2099/01/01 21:00", "dc": "Mana", "world": "Anima", "comment": ""}
+            panel = pf_module.RecruitmentPanel(cog, 10 ** 12 + burst, data)
+            cog.add_panel(panel, channel.id, 10 ** 12 + burst)
+            burst_started = time.perf_counter()
+
+            async def click(user_id, role):
+                interaction = FakeInteraction(bot, user_id, channel, SimpleNamespace(id=panel.message_id))
+                started = time.perf_counter()
+                await pf_module.PanelButton(panel.panel_id, f"role:{role}").callback(interaction)
+                clicks.append(interaction.responded_at - started)
+
+            # 8人がほぼ同時に別々のロールを押す
+            await asyncio.gather(*(click(100 + i, role) for i, role in enumerate(panel.roles)))
+            # まとめ編集が終わるまで待つ
+            while panel.panel_id in cog.render_tasks:
+                await asyncio.sleep(0.01)
+            settles.append(time.perf_counter() - burst_started)
+            cog.forget_panel(panel.panel_id)
+
+        from outbound import get_outbound
+        await get_outbound().close()
+        return {
+            "click_response": summarize(clicks),
+            "burst_settled": summarize(settles),
+            "edits_per_burst": round(channel.edits / max(1, args.bursts), 2),
+            "notifications": len(channel.sent),
+        }
+    return scenario
+
+
+def autocomplete_scenario(bot, args):
+    cog = bot.get_cog("Knowledge")
+    names = list(cog.data["macros"])
+    channel = FakeChannel(2, 0)
+
+    async def scenario():
+        latencies = []
+        rng = random.Random(1)
+        for _ in range(args.typing):
+            target = rng.choice(names)
+            # 1文字ずつ打つ（前方一致）＋ 途中から打つ（部分一致）
+            inputs = [target[:i] for i in range(1, len(target) + 1)] + [target[len(target) // 2:]]
+            for text in inputs:
+                interaction = FakeInteraction(bot, 1, channel)
+                started = time.perf_counter()
+                await cog.macro_autocomplete(interaction, text)
+                latencies.append(time.perf_counter() - started)
+                # キー入力の合間に他の処理も動けるように（ループの遅れも測れるように）
+                await asyncio.sleep(0)
+        return {"autocomplete": summarize(latencies), "macros": len(names)}
+    return scenario
+
+
+def chat_search_scenario(bot, args):
+    chat = bot.get_cog("Chat")
+    search = bot.get_cog("Search")
+    channel = FakeChannel(3, args.discord_latency)
+    queries = [f"零式{i}層 ギミック" for i in range(args.distinct_queries)]
+
+    async def scenario():
+        chat_times, search_times, first_chunk = [], [], []
+
+        async def one_chat(user_id, n):
+            interaction = FakeInteraction(bot, user_id, channel)
+            started = time.perf_counter()
+            await chat.chat.callback(chat, interaction, f"極神龍のマクロ教えて {n}")
+            chat_times.append(time.perf_counter() - started)
+            if interaction.first_followup_at: first_chunk.append(interaction.first_followup_at - started)
+
+        async def one_search(user_id, n):
+            interaction = FakeInteraction(bot, user_id, channel)
+            started = time.perf_counter()
+            await search.search.callback(search, interaction, queries[n % len(queries)])
+            search_times.append(time.perf_counter() - started)
+
+        jobs = []
+        for round_no in range(args.rounds):
+            for user in range(args.users):
+                jobs.append(one_chat(1000 + user, round_no))
+                jobs.append(one_search(2000 + user, round_no * args.users + user))
+        await asyncio.gather(*jobs)
+        return {
+            "chat_total": summarize(chat_times),
+            "chat_first_text": summarize(first_chunk),
+            "search_total": summarize(search_times),
+        }
+    return scenario
+
+
+# ---------------- 準備 ----------------
+def write_macros(count):
+    rng = random.Random(0)
+    bosses = ["極", "零式", "絶", "異聞", "アルカディア", "万魔殿", "エデン", "オメガ"]
+    words = ["神龍", "グラシャラボラス", "ヴァリガルマンダ", "ゼロムス", "ルビカンテ", "もうひとつの未来", "竜詩戦争", "バハムート", "アレキサンダー"]
+    macros = {}
+    for i in range(count):
+        name = f"{rng.choice(bosses)}{rng.choice(words)}{i}"
+        macros[name] = "\n".join(f"/p 【{rng.choice(['MT', 'ST', 'H1', 'H2', 'D1', 'D2', 'D3', 'D4'])}】散開 {j}" for j in range(8))
+    os.makedirs("data", exist_ok=True)
+    with open(os.path.join("data", "knowledge.json"), "w", encoding="utf-8") as f:
+        json.dump({"macros": macros, "strategies": {}}, f, ensure_ascii=False)
+
+
+async def run(args):
+    import discord
+    from discord.ext import commands
+    from startup import load_extensions
+    from metrics import TimedCommandTree
+
+    bot = commands.Bot(command_prefix="!", intents=discord.Intents.none(), tree_cls=TimedCommandTree)
+    bot.cog_snapshots = {}
+    extensions = [f"cogs.{os.path.splitext(f)[0]}" for f in os.listdir(os.path.join(ROOT, "cogs")) if f.endswith(".py")]
+    results = {}
+    async with bot:
+        loaded = await load_extensions(bot, sorted(extensions), {})
+        print(f"✅ Loaded: {', '.join(loaded)}")
+
+        # LLM と検索は偽物に差し替える
+        from llm import get_router
+        get_router().providers["gemini"] = StubProvider(args.llm_latency, args.chunks)
+        bot.get_cog("Search").fetch_one = stub_search(args.search_latency)
+        # 回数制限に当たると速さではなく断った数を測ってしまうので、ベンチでは外す
+        from quota import get_quotas
+        get_quotas().quotas = {}
+
+        scenarios = {
+            "panel": panel_scenario,
+            "autocomplete": autocomplete_scenario,
+            "chat_search": chat_search_scenario,
+        }
+        for name, make in scenarios.items():
+            if args.scenario in ("all", name):
+                await measure(name, make(bot, args), results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="オフライン負荷テスト")
+    parser.add_argument("--scenario", default="all", choices=["all", "panel", "autocomplete", "chat_search"])
+    parser.add_argument("--bursts", type=int, default=30, help="募集パネルの8連打を何回やるか")
+    parser.add_argument("--macros", type=int, default=5000, help="登録しておくマクロの数")
+    parser.add_argument("--typing", type=int, default=200, help="オートコンプリートで何件分タイプするか")
+    parser.add_argument("--users", type=int, default=10, help="/chat と /search を同時に使う人数")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--distinct-queries", type=int, default=5, help="検索クエリの種類（少ないほどキャッシュが効く）")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--chunks", type=int, default=8, help="ストリーミングのチャンク数")
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--discord-latency", type=float, default=0.03)
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ota_bench_")
+    cwd = os.getcwd()
+    json_path = os.path.abspath(args.json) if args.json else None
+    os.chdir(workdir)
+    try:
+        write_macros(args.macros)
+        # ストリーミング表示の間隔などは本番と同じ設定で動かす
+        os.environ.setdefault("GEMINI_API_KEY", "bench")
+        os.environ.setdefault("AUTO_SYNC", "0")
+        tracemalloc.start()
+        results = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 {json_path} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,66 +1,164 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import google.generativeai as genai
+import asyncio
+import math
 import os
+import time
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from llm import get_pool, get_router, estimate_tokens, fit_history, LLM_BUDGETS
+from session_store import SessionStore, to_contents
+from hot_reload import take_snapshot, handing_off
+from quota import get_quotas
+from prompts import LUCY_SYSTEM_PROMPT
 
 # .envを読み込む
 load_dotenv()
 
+# Botに必要な設定（スラッシュコマンドだけなので guilds のみ）
+PROFILE = {"intents": ["guilds"]}
+
+# ストリーミング表示の設定
+DISCORD_LIMIT = 2000
+STREAM_EDIT_INTERVAL = float(os.getenv("CHAT_STREAM_INTERVAL", "1.0")) # 編集・追加送信の最短間隔(秒)。チャンクが大きくても縮めない
+STREAM_CURSOR = " ▌"
+
+JST = timezone(timedelta(hours=9))
+
+def split_pages(text, limit=DISCORD_LIMIT):
+    # 2000文字を超える分は次のメッセージへ（できるだけ改行で区切る）
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0: cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    pages.append(text)
+    return pages
+
+# ------------------------------------------------------------------
+# 返信を少しずつ編集して表示するクラス
+# 編集回数はまとめて減らす（Discordの編集レート制限に引っかからないように）
+# ------------------------------------------------------------------
+class StreamingReply:
+    def __init__(self, interaction, header):
+        self.interaction = interaction
+        self.header = header
+        self.text = ""
+        self.messages = []   # 送信済みのfollowupメッセージ
+        self.shown = []      # 各メッセージに最後に表示した内容
+        self.last_flush = 0.0
+
+    async def feed(self, chunk):
+        if not chunk: return
+        self.text += chunk
+        # 最初のチャンクはすぐ出す（待ち時間を短く見せる）。あとは最短間隔を必ず空けて、その間の分をまとめて出す
+        if not self.messages or time.monotonic() - self.last_flush >= STREAM_EDIT_INTERVAL:
+            await self.flush()
+
+    async def finish(self):
+        await self.flush(final=True)
+
+    async def flush(self, final=False):
+        body = self.header + self.text
+        pages = split_pages(body if final else body + STREAM_CURSOR)
+        for i, page in enumerate(pages):
+            if i < len(self.messages):
+                # 中身が変わったメッセージだけ編集する
+                if self.shown[i] != page:
+                    await self.messages[i].edit(content=page)
+                    self.shown[i] = page
+            else:
+                msg = await self.interaction.followup.send(page, ephemeral=True, wait=True)
+                self.messages.append(msg)
+                self.shown.append(page)
+        # カーソル分だけはみ出していたメッセージが残っていたら消す
+        while len(self.messages) > len(pages):
+            await self.messages.pop().delete()
+            self.shown.pop()
+        self.last_flush = time.monotonic()
+
 class Chat(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        try:
-            api_key = os.getenv("GEMINI_API_KEY")
-            if not api_key:
-                print("⚠️ 警告: GEMINI_API_KEY が見つかりません！.envを確認してください。")
-            else:
-                genai.configure(api_key=api_key)
-                # ★修正点: エラーが出ない安定版の 'gemini-pro' に変更しました
-                self.model = genai.GenerativeModel('gemini-pro')
-                self.sessions = {}
-        except Exception as e:
-            print(f"Gemini Init Error: {e}")
+        self.pool = get_pool()
+        # どのモデルに投げるか・失敗した時の切り替えは llm.LLMRouter が決める
+        self.router = get_router()
+        self.quotas = get_quotas()
+        # リロードの時は会話履歴（DB接続ごと）を前のCogから引き継ぐ
+        state = take_snapshot(self)
+        self.store = state["store"] if state else SessionStore()
+        if not os.getenv("GEMINI_API_KEY"):
+            print("⚠️ 警告: GEMINI_API_KEY が見つかりません！.envを確認してください。")
+
+    def build_prompt(self, message, history):
+        # 今回の発言に【現在時刻】と【参考データ】（関係ありそうなマクロ・ボードだけ）を付ける
+        # 履歴には元の発言だけを残すので、プロンプトの大きさは登録数が増えても変わらない
+        lines = [f"【現在時刻】{datetime.now(JST).strftime('%Y/%m/%d %H:%M')}"]
+        knowledge = self.bot.get_cog("Knowledge")
+        if knowledge:
+            # 「それのH1版」のような続きの質問でも引けるように、直前の質問も検索に使う
+            last_question = next((t for r, t in reversed(history) if r == "user"), "")
+            reference = knowledge.reference_for(f"{message}\n{last_question}")
+            if reference: lines.append(f"【参考データ】\n{reference}")
+        lines.append("")
+        lines.append(message)
+        return "\n".join(lines)
 
     @app_commands.command(name="chat", description="るーしーと内緒話をします（履歴を覚えます・他人には見えません）")
     async def chat(self, interaction: discord.Interaction, message: str):
-        await interaction.response.defer(ephemeral=True)
         user_id = interaction.user.id
+        # 使いすぎ防止（1人・1サーバーあたりの回数制限）
+        wait = self.quotas.check("chat", user_id, interaction.guild_id)
+        if wait:
+            await interaction.response.send_message(f"ちょっと話しすぎかも！あと{math.ceil(wait)}秒待ってからまた話しかけてね！", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True)
 
         try:
-            # セッション（会話の履歴）がなければ新しく作る
-            if user_id not in self.sessions:
-                self.sessions[user_id] = self.model.start_chat(history=[])
-            
-            chat_session = self.sessions[user_id]
-            
-            # メッセージを送信
-            response = chat_session.send_message(message)
-            
-            reply_text = response.text
-            # 文字数が多すぎたらカットする
-            if len(reply_text) > 1900:
-                reply_text = reply_text[:1900] + "..."
-
-            await interaction.followup.send(f"**あなた:** {message}\n\n**るーしー:**\n{reply_text}", ephemeral=True)
+            # 履歴の読み込み～保存までは同じユーザーの別リクエストと混ざらないようにする
+            async with self.pool.user_slot(user_id):
+                # 会話の履歴（メモリに無ければDBから読み直す）
+                history = self.store.get(user_id)
+                # 1回に送る量の上限を超えたら、古い履歴から削る（キャラ設定の分は先に引いておく）
+                prompt = [{"role": "user", "parts": [self.build_prompt(message, history)]}]
+                budget = LLM_BUDGETS["chat"] - estimate_tokens(LUCY_SYSTEM_PROMPT)
+                contents = fit_history([], to_contents(history), prompt, budget)
+
+                # メッセージを送信（ワーカースレッドでストリーミング受信して、届いた分から表示する）
+                reply = StreamingReply(interaction, f"**あなた:** {message}\n\n**るーしー:**\n")
+                async with aclosing(self.router.stream("chat", contents, LUCY_SYSTEM_PROMPT, user_id=user_id)) as chunks:
+                    async for chunk in chunks:
+                        await reply.feed(chunk.text)
+                await reply.finish()
+
+                # 最後まで返せたやり取りだけ履歴に残す
+                self.store.append(user_id, message, reply.text)
+
+        except asyncio.TimeoutError:
+            print(f"⏱️ Chat Timeout (User: {interaction.user.name})")
+            await interaction.followup.send("ごめん、考えるのに時間がかかりすぎちゃった…もう一回送ってみて！", ephemeral=True)
 
         except Exception as e:
             # エラー内容をターミナルに表示
             print(f"❌ Chat Error (User: {interaction.user.name}): {e}")
-            
-            # エラーが起きたら履歴をリセットして、次は動くようにする
-            self.sessions[user_id] = self.model.start_chat(history=[])
-            
-            # ユーザーへのメッセージ
-            await interaction.followup.send(f"ごめん、ちょっとエラーが出ちゃったみたい。（モデルをgemini-proに変更して再試行してね）\nエラー内容: {e}", ephemeral=True)
+
+            # 別のモデルでもダメだった時だけここに来る。履歴は消さずに残しておく
+            await interaction.followup.send("ごめん、今ちょっと調子が悪いみたい…今までのお話は覚えてるから、少ししてからもう一回送ってね！", ephemeral=True)
 
     @app_commands.command(name="forget", description="会話の履歴をリセットします")
     async def forget(self, interaction: discord.Interaction):
         # 強制的に履歴を空にする
-        if hasattr(self, 'model'):
-             self.sessions[interaction.user.id] = self.model.start_chat(history=[])
+        self.store.reset(interaction.user.id)
         await interaction.response.send_message("記憶をリセットしたよ！", ephemeral=True)
 
+    def export_state(self):
+        return {"store": self.store}
+
+    async def cog_unload(self):
+        if not handing_off(self): self.store.close()
+
 async def setup(bot):
     await bot.add_cog(Chat(bot))
\ No newline at end of file
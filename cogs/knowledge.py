@@ -1,16 +1,22 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-from discord.ui import Button, View
-import json
-import os
+from discord.ui import Button
+from knowledge_store import make_store, NAMESPACES
+from name_index import NameIndex
+from retrieval import BM25Index, index_text, build_reference, RAG_TOP_K
+from hot_reload import take_snapshot, handing_off
+from metrics import timed, TimedView, COMMAND_SECONDS
 
-DATA_FILE = "data/knowledge.json"
+# Botに必要な設定（スラッシュコマンドだけなので guilds のみ）
+PROFILE = {"intents": ["guilds"]}
 
 # ------------------------------------------------------------------
 # 確認用ビュー (Yes/Noボタン)
 # ------------------------------------------------------------------
-class ConfirmActionView(View):
+class ConfirmActionView(TimedView):
+    component = "knowledge"
+
     def __init__(self, cog, action_type, name, content=None):
         super().__init__(timeout=60)
         self.cog = cog
@@ -20,31 +26,28 @@ class ConfirmActionView(View):
 
     @discord.ui.button(label="はい (実行)", style=discord.ButtonStyle.green)
     async def confirm(self, interaction: discord.Interaction, button: Button):
-        # アクションの種類によって処理を分岐
+        # アクションの種類によって処理を分岐（保存は1件ずつ）
+        cog = self.cog
         if self.action_type == "add_macro":
-            self.cog.data["macros"][self.name] = self.content
+            cog.upsert("macros", self.name, self.content)
             msg = f"✅ マクロ **「{self.name}」** を登録しました！"
         
         elif self.action_type == "del_macro":
-            if self.name in self.cog.data["macros"]:
-                del self.cog.data["macros"][self.name]
+            if cog.delete("macros", self.name):
                 msg = f"🗑️ マクロ **「{self.name}」** を削除しました。"
             else:
                 msg = "❌ エラー: そのマクロは既にありません。"
 
         elif self.action_type == "add_strat":
-            self.cog.data["strategies"][self.name] = self.content
+            cog.upsert("strategies", self.name, self.content)
             msg = f"✅ 攻略ボード **「{self.name}」** を登録しました！"
 
         elif self.action_type == "del_strat":
-            if self.name in self.cog.data["strategies"]:
-                del self.cog.data["strategies"][self.name]
+            if cog.delete("strategies", self.name):
                 msg = f"🗑️ 攻略ボード **「{self.name}」** を削除しました。"
             else:
                 msg = "❌ エラー: そのボードは既にありません。"
         
-        # 保存して終了
-        self.cog.save_data()
         await interaction.response.edit_message(content=msg, view=None, embed=None)
 
     @discord.ui.button(label="いいえ (キャンセル)", style=discord.ButtonStyle.red)
@@ -57,20 +60,44 @@ class ConfirmActionView(View):
 class Knowledge(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.data = self.load_data()
-
-    def load_data(self):
-        if not os.path.exists("data"): os.makedirs("data")
-        if not os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump({"macros": {}, "strategies": {}}, f)
-            return {"macros": {}, "strategies": {}}
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-
-    def save_data(self):
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, indent=4, ensure_ascii=False)
+        # リロードの時はストアと検索インデックスを前のCogから引き継ぐ
+        state = take_snapshot(self)
+        self.store = state["store"] if state else make_store()
+        self.data = self.store.data # 読み取り用
+        # オートコンプリート用の検索インデックス（登録・削除のたびに差分だけ更新）
+        self.indexes = state["indexes"] if state else {ns: NameIndex(self.store.keys(ns)) for ns in NAMESPACES}
+        # /chat の参考データ用の全文インデックス（こちらも登録・削除のたびに更新）
+        # 全文インデックスを持っていない古いCogからのリロードでは、ここで作る
+        self.retriever = state.get("retriever") if state else None
+        if self.retriever is None: self.retriever = self.build_retriever()
+
+    def build_retriever(self):
+        retriever = BM25Index()
+        for ns in NAMESPACES:
+            for name, value in self.data[ns].items():
+                retriever.add(ns, name, index_text(ns, value))
+        return retriever
+
+    def reference_for(self, query, k=RAG_TOP_K):
+        # 質問に関係ありそうなマクロ・ボードだけを【参考データ】用の文章にする
+        return build_reference(self.retriever.search(query, k), self.data)
+
+    def upsert(self, ns, name, value):
+        self.store.upsert(ns, name, value)
+        self.indexes[ns].add(name)
+        self.retriever.add(ns, name, index_text(ns, value))
+
+    def delete(self, ns, name):
+        if not self.store.delete(ns, name): return False
+        self.indexes[ns].remove(name)
+        self.retriever.remove(ns, name)
+        return True
+
+    def export_state(self):
+        return {"store": self.store, "indexes": self.indexes, "retriever": self.retriever}
+
+    async def cog_unload(self):
+        if not handing_off(self): self.store.close()
 
     def format_macro(self, content):
         if "\n" not in content and "/p " in content:
@@ -115,7 +142,8 @@ class Knowledge(commands.Cog):
     @delete_macro.autocomplete("name")
     @view_macro.autocomplete("name")
     async def macro_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=k, value=k) for k in self.data["macros"].keys() if current.lower() in k.lower()][:25]
+        with timed(COMMAND_SECONDS, command=(interaction.data or {}).get("name", "?"), kind="autocomplete"):
+            return [app_commands.Choice(name=k, value=k) for k in self.indexes["macros"].search(current)]
 
     # ===============================================================
     # ストラテジーボード機能
@@ -153,7 +181,8 @@ class Knowledge(commands.Cog):
     @delete_strat.autocomplete("name")
     @view_strat.autocomplete("name")
     async def strat_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=k, value=k) for k in self.data["strategies"].keys() if current.lower() in k.lower()][:25]
+        with timed(COMMAND_SECONDS, command=(interaction.data or {}).get("name", "?"), kind="autocomplete"):
+            return [app_commands.Choice(name=k, value=k) for k in self.indexes["strategies"].search(current)]
 
 async def setup(bot):
     await bot.add_cog(Knowledge(bot))
\ No newline at end of file
@@ -1,53 +1,167 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+import json
 import os
+import re
 from datetime import datetime, timedelta
+from hot_reload import take_snapshot
+from outbound import get_outbound, LOW
+
+# ------------------------------------------------------------------
+# 監視ルール
+# data/monitor_rules.json を書き換えると自動で読み直す（再起動不要）
+# {
+#   "channel_id": 123,                      # 怒るチャンネル（省略時は CHAT_CHANNEL_ID）
+#   "rules": [{
+#     "user_id": 456,
+#     "games": ["FINAL FANTASY", "Steam"],  # 部分一致
+#     "weekdays": [0, 1, 2, 3, 4],          # 0=月曜
+#     "hours": [10, 18],                    # 10時～18時（日本時間）
+#     "cooldown_hours": null,               # null なら1日1回
+#     "message": "{mention} ... 『{game}』 ..."
+#   }]
+# }
+# ファイルが無い場合は TARGET_USER_ID だけを従来どおり監視する
+# ------------------------------------------------------------------
+# Botに必要な設定
+# プレゼンスを受け取るには presences + members が必要。ただしメンバーは全員キャッシュせず、
+# 監視対象の人だけ起動時に取得してキャッシュに入れる（大きいサーバーでもメモリを食わない）
+# どちらも特権intentなので、Developer Portal の Bot 設定で
+# 「PRESENCE INTENT」「SERVER MEMBERS INTENT」を有効にしておくこと。
+# 有効になっていなければ、この監視だけ外して起動し直す（他の機能は止めない）。
+PROFILE = {"intents": ["guilds", "members", "presences"], "member_cache": [], "chunk_guilds": False, "optional": True}
+
+RULES_FILE = "data/monitor_rules.json"
+RELOAD_INTERVAL = 30 # 秒
+NOT_LOADED = object()
+
+DEFAULT_GAMES = ["FINAL FANTASY", "Monster Hunter", "Steam"]
+DEFAULT_MESSAGE = (
+    "{mention} **ちょっと！平日のお昼だよ！？** 😡\n"
+    "『{game}』やってる場合じゃないでしょ！研究進んだの！？"
+)
+
+class MonitorRule:
+    __slots__ = ("user_id", "matcher", "weekdays", "start_hour", "end_hour", "cooldown", "message", "channel_id")
+
+    def __init__(self, conf, default_channel_id):
+        self.user_id = int(conf["user_id"])
+        games = conf.get("games", DEFAULT_GAMES)
+        # ゲーム名のリストは1つの正規表現にまとめておく
+        self.matcher = re.compile("|".join(re.escape(g) for g in games))
+        self.weekdays = frozenset(conf.get("weekdays", [0, 1, 2, 3, 4]))
+        self.start_hour, self.end_hour = conf.get("hours", [10, 18])
+        hours = conf.get("cooldown_hours")
+        self.cooldown = timedelta(hours=hours) if hours else None
+        self.message = conf.get("message", DEFAULT_MESSAGE)
+        # 使える差し込みは {mention} と {game} だけ。間違いは怒る時ではなく読み込みの時に見つける
+        try:
+            self.message.format(mention="", game="")
+        except (KeyError, IndexError, ValueError, AttributeError) as e:
+            raise ValueError(f"message のテンプレートが不正です（使えるのは {{mention}} と {{game}}）: {e!r}")
+        self.channel_id = int(conf.get("channel_id") or default_channel_id or 0)
+
+    def in_window(self, jst_now):
+        return jst_now.weekday() in self.weekdays and self.start_hour <= jst_now.hour < self.end_hour
+
+    def cooled_down(self, last, jst_now):
+        if last is None: return True
+        if self.cooldown is None:
+            return last.date() != jst_now.date() # 1日1回
+        return jst_now - last >= self.cooldown
+
+def load_rules():
+    env_channel = os.getenv("CHAT_CHANNEL_ID")
+    if os.path.exists(RULES_FILE):
+        with open(RULES_FILE, "r", encoding="utf-8") as f:
+            conf = json.load(f)
+        channel_id = conf.get("channel_id") or env_channel
+        rules = []
+        for i, r in enumerate(conf.get("rules", [])):
+            try:
+                rules.append(MonitorRule(r, channel_id))
+            except (ValueError, KeyError, TypeError) as e:
+                # おかしなルールだけ外して、残りは使う
+                print(f"⚠️ Monitor Cog: {i + 1}件目のルールを読み込めませんでした: {e}")
+    else:
+        target = os.getenv("TARGET_USER_ID")
+        rules = [MonitorRule({"user_id": target}, env_channel)] if target else []
+    return {r.user_id: r for r in rules}
 
 class Monitor(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.last_scold_date = None # 最後に怒った日を覚えるメモ
-        
-        # ID読み込み
+        self.rules = {}      # {user_id: MonitorRule}
+        self.last_fired = {} # {user_id: 最後に怒った時刻(日本時間)}
+        self.rules_mtime = NOT_LOADED
+        # リロードの時は「今日もう怒ったか」を前のCogから引き継ぐ（ルールは新しいコードで読み直す）
+        state = take_snapshot(self)
+        if state: self.last_fired = state["last_fired"]
+        self.reload_rules()
+
+    async def cog_load(self):
+        self.watch_rules.start()
+
+    def export_state(self):
+        return {"last_fired": self.last_fired}
+
+    async def cog_unload(self):
+        self.watch_rules.cancel()
+
+    def reload_rules(self):
+        mtime = os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None
+        if mtime == self.rules_mtime: return False
         try:
-            self.chat_id = int(os.getenv("CHAT_CHANNEL_ID"))
-            self.target_id = int(os.getenv("TARGET_USER_ID"))
-        except:
-            print("⚠️ Monitor Cog: ID Load Error")
+            self.rules = load_rules()
+            self.rules_mtime = mtime
+            print(f"👀 Monitor: {len(self.rules)} 件の監視ルールを読み込みました")
+            return True
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # 書きかけのファイルなどで失敗したら、今までのルールのまま
+            print(f"⚠️ Monitor Cog: ルール読み込みエラー: {e}")
+            return False
+
+    async def cache_targets(self):
+        # 監視対象の人だけメンバーキャッシュに入れる（キャッシュに居ない人のプレゼンスは届かないため）
+        for guild in self.bot.guilds:
+            missing = [uid for uid in self.rules if guild.get_member(uid) is None]
+            for i in range(0, len(missing), 100):
+                try:
+                    await guild.query_members(user_ids=missing[i:i + 100], presences=True, cache=True)
+                except Exception as e:
+                    print(f"⚠️ Monitor Cog: メンバー取得エラー ({guild.name}): {e}")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await self.cache_targets()
+
+    @tasks.loop(seconds=RELOAD_INTERVAL)
+    async def watch_rules(self):
+        if self.reload_rules() and self.bot.is_ready():
+            await self.cache_targets()
 
     # ステータス変化を監視するイベント
     @commands.Cog.listener()
     async def on_presence_update(self, before, after):
-        # ターゲット（太田さん）以外は無視
-        if after.id != self.target_id: return
+        # 監視対象以外は辞書を1回引くだけで終わり
+        rule = self.rules.get(after.id)
+        if rule is None: return
 
         # ゲームを起動したかチェック
-        if after.activity and after.activity != before.activity:
-            game_name = after.activity.name
-            
-            # 監視対象のゲームリスト
-            target_games = ["FINAL FANTASY", "Monster Hunter", "Steam"]
-            
-            # ゲーム名が含まれているかチェック（部分一致）
-            if any(t_game in game_name for t_game in target_games):
-                
-                # 時間チェック（日本時間）
-                jst_now = datetime.utcnow() + timedelta(hours=9)
-                today_str = jst_now.strftime('%Y-%m-%d')
-
-                # 【条件】平日(月～金) の 10時～18時
-                if jst_now.weekday() < 5 and 10 <= jst_now.hour < 18:
-                    
-                    # 今日まだ怒ってない場合だけ怒る
-                    if self.last_scold_date != today_str:
-                        channel = self.bot.get_channel(self.chat_id)
-                        if channel:
-                            await channel.send(
-                                f"<@{self.target_id}> **ちょっと！平日のお昼だよ！？** 😡\n"
-                                f"『{game_name}』やってる場合じゃないでしょ！研究進んだの！？"
-                            )
-                            # 「今日怒った」と記録
-                            self.last_scold_date = today_str
+        if not after.activity or after.activity == before.activity: return
+        game_name = after.activity.name
+        if not game_name or not rule.matcher.search(game_name): return
+
+        # 時間チェック（日本時間）
+        jst_now = datetime.utcnow() + timedelta(hours=9)
+        if not rule.in_window(jst_now): return
+        if not rule.cooled_down(self.last_fired.get(after.id), jst_now): return
+
+        channel = self.bot.get_channel(rule.channel_id)
+        if channel:
+            get_outbound().send(channel, rule.message.format(mention=f"<@{after.id}>", game=game_name), priority=LOW, dedupe=f"monitor:{after.id}")
+            # 「怒った」と記録
+            self.last_fired[after.id] = jst_now
 
 async def setup(bot):
     await bot.add_cog(Monitor(bot))
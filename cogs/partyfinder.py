@@ -3,8 +3,34 @@ from discord.ext import commands
 from discord import app_commands
 from discord.ui import Button, View, Select, Modal, TextInput
 import os
+import asyncio
 import datetime
+import time
 import traceback
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from panel_store import PanelStore
+from scheduler import Scheduler
+from hot_reload import take_snapshot, handing_off
+from metrics import registry, timed, TimedView, COMPONENT_SECONDS
+from outbound import get_outbound, HIGH, NORMAL, LOW
+
+# Botに必要な設定（フォーラム/スレッドを引くので guilds のみ。メンバー名は無ければ控えの名前を使う）
+PROFILE = {"intents": ["guilds"]}
+
+PANEL_CACHE_SIZE = int(os.getenv("PANEL_CACHE_SIZE", "32")) # メモリに置いておく募集パネルの数
+PANEL_EDIT_DELAY = float(os.getenv("PANEL_EDIT_DELAY", "0.5")) # 連打をまとめる時間(秒)
+RECRUIT_REMIND_BEFORE = float(os.getenv("RECRUIT_REMIND_MINUTES", "15")) * 60   # 開始何分前にお知らせするか
+RECRUIT_ARCHIVE_AFTER = float(os.getenv("RECRUIT_ARCHIVE_HOURS", "3")) * 3600   # 開始何時間後にスレッドを閉じるか
+HANDOFF_TIMEOUT = 10 # !reload の時に、処理中のボタン操作が終わるのを待つ最大秒数
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+def parse_start_time(text):
+    # "2025/1/23 21:00" (日本時間) -> UNIX時間
+    try:
+        return datetime.datetime.strptime(text, "%Y/%m/%d %H:%M").replace(tzinfo=JST).timestamp()
+    except (TypeError, ValueError):
+        return None
 
 JP_DCS = {
     "Elemental": ["Aegis", "Atomos", "Carbuncle", "Garuda", "Gungnir", "Kujata", "Tonberry", "Typhon"],
@@ -44,31 +70,90 @@ def get_emoji_safe(role_name):
         return discord.PartialEmoji.from_str(icon_str)
     return icon_str
 
+def get_role_style(role_name):
+    if role_name in ["MT", "ST"] or "Tank" in role_name: return discord.ButtonStyle.primary
+    if role_name in ["H1", "H2"] or "Healer" in role_name: return discord.ButtonStyle.success
+    if "D" in role_name: return discord.ButtonStyle.danger
+    return discord.ButtonStyle.secondary
+
+# 募集タイプごとのロール
+PANEL_ROLES = {
+    "LIGHT": ["Tank", "Healer", "DPS1", "DPS2"],
+    "FULL": ["MT", "ST", "H1", "H2", "D1", "D2", "D3", "D4"],
+    "FREE8": [f"参加枠{i}" for i in range(1, 9)],
+    "FREE4": [f"参加枠{i}" for i in range(1, 5)],
+}
+
+# 絵文字とボタンの色は起動時に1回だけ計算しておく（クリックのたびにパースしない）
+ALL_ROLES = {r for roles in PANEL_ROLES.values() for r in roles} | {"Any"}
+ROLE_EMOJIS = {r: get_emoji_safe(r) for r in ALL_ROLES}
+ROLE_STYLES = {r: get_role_style(r) for r in ALL_ROLES}
+
+# ------------------------------------------------------------------
+# 募集パネルのボタン
+# custom_id に「パネルID」と「操作」を入れておき、どのパネルが押されたか分かるようにする。
+# Botに登録するのはこのクラス1つだけで、押された時にDBからパネルを読み直して処理する
+# （再起動後の古いパネルでもボタンが動く）
+# ------------------------------------------------------------------
+class PanelButton(discord.ui.DynamicItem[Button], template=r"rec:(?P<pid>[0-9]+):(?P<action>.+)"):
+    def __init__(self, panel_id, action, **kwargs):
+        super().__init__(Button(custom_id=f"rec:{panel_id}:{action}", **kwargs))
+        self.panel_id = panel_id
+        self.action = action
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: Button, match):
+        return cls(int(match["pid"]), match["action"])
+
+    async def callback(self, interaction: discord.Interaction):
+        cog = interaction.client.get_cog("PartyFinder")
+        if cog is None: return
+        with timed(COMPONENT_SECONDS, component="panel", action=self.action.split(":")[0]):
+            await cog.dispatch_panel(interaction, self.panel_id, self.action)
+
 # ------------------------------------------------------------------
 # 調整枠用のメモ入力Modal
 # ------------------------------------------------------------------
 class AnyRoleModal(Modal, title="調整枠で参加"):
     note = TextInput(label="出せるロール/ジョブは？", placeholder="例: タンクとヒラなら何でも！", required=True)
 
-    def __init__(self, parent_view, user_name):
+    def __init__(self, cog, panel_id, user):
         super().__init__()
-        self.parent_view = parent_view
-        self.user_name = user_name
+        self.cog = cog
+        self.panel_id = panel_id
+        self.user = user
 
     async def on_submit(self, interaction: discord.Interaction):
+        with timed(COMPONENT_SECONDS, component="panel", action="any_note"):
+            await self.submit(interaction)
+
+    async def submit(self, interaction: discord.Interaction):
+        # 入力中に !reload でCogが入れ替わっていることもあるので、今のCogを使う
+        cog = interaction.client.get_cog("PartyFinder") or self.cog
+        if await cog.refuse_during_handoff(interaction): return
+        async with cog.handling():
+            await self.join(interaction, cog)
+
+    async def join(self, interaction, cog):
         try:
-            entry = {"name": self.user_name, "note": self.note.value}
-            self.parent_view.any_members = [m for m in self.parent_view.any_members if m["name"] != self.user_name]
-            self.parent_view.any_members.append(entry)
-            
-            for r, u in self.parent_view.members.items():
-                if u == self.user_name: self.parent_view.members[r] = None
-                
-            self.parent_view.update_buttons()
-            await interaction.response.edit_message(embed=self.parent_view.make_embed(), view=self.parent_view)
+            # 入力中にパネルが入れ替わっていることがあるので、最新の状態を取り直す
+            panel = cog.get_panel(self.panel_id)
+            if panel is None:
+                await interaction.response.send_message("この募集はもう終了しています。", ephemeral=True)
+                return
+
+            # ボタンを押してから入力し終わるまでに満員になっているかもしれないので、ここで改めてチェック
+            async with cog.panel_lock(self.panel_id):
+                result = panel.join_any(self.user.id, self.user.display_name, self.note.value)
+                just_filled = panel.mark_full()
+            if result == "full":
+                await interaction.response.send_message(f"❌ **満員です！**", ephemeral=True)
+                return
+
+            await cog.publish(interaction, panel)
             
             # 満員チェック
-            await self.parent_view.check_full_and_notify(interaction)
+            if just_filled: await panel.notify_full(interaction)
             
         except Exception as e:
             print(f"❌ Modal Error: {e}")
@@ -76,162 +161,273 @@ class AnyRoleModal(Modal, title="調整枠で参加"):
 
 # ------------------------------------------------------------------
 # 最終的な募集パネル
+# 参加者はユーザーIDで管理する（名前が被っても、途中で名前を変えても大丈夫）
+#   roles:     ロール名のリスト
+#   seats:     各ロールに座っているユーザーID (空きは None)
+#   seat_of:   ユーザーID → 座っている席番号（逆引き）
+#   any_members: ユーザーID → メモ（調整枠、参加順）
+#   names:     ユーザーID → 最後に見た名前（表示用の控え）
 # ------------------------------------------------------------------
 class RecruitmentPanel(View):
-    def __init__(self, data):
+    def __init__(self, cog, panel_id, data, state=None):
         super().__init__(timeout=None)
+        # クリックは PanelButton が受けるので、このView自体はBotに保持させない
+        # （stop済みのViewは送信/編集してもメモリに残らない）
+        self.stop()
+        self.cog = cog
+        self.panel_id = panel_id
         self.data = data
-        self.members = {}
         self.notified_full = False # 通知済みフラグ
+        self.channel_id = None
+        self.message_id = None
+        self.version = 0              # 状態が変わるたびに増やす（編集が追いついているかの判定用）
+        self.edit_lock = asyncio.Lock() # メッセージ編集の順番を守る
+        self.last_edit = 0.0
+        self.shown_key = None   # Discord上に最後に表示した内容（見た目が同じなら編集しない）
+        self.embed_key = None
+        self.embed = None
         
         if "4" in data["type"] or "LIGHT" in data["type"]:
             self.max_members = 4
         else:
             self.max_members = 8
 
-        if data["type"] == "LIGHT": roles = ["Tank", "Healer", "DPS1", "DPS2"]
-        elif data["type"] == "FULL": roles = ["MT", "ST", "H1", "H2", "D1", "D2", "D3", "D4"]
-        elif data["type"] == "FREE8": roles = [f"参加枠{i}" for i in range(1, 9)]
-        else: roles = [f"参加枠{i}" for i in range(1, 5)]
-        
-        for r in roles: self.members[r] = None
-        self.any_members = []
+        if state is not None:
+            # 保存済みの状態から復元
+            self.roles = state["roles"]
+            self.seats = state["seats"]
+            self.any_members = {int(uid): note for uid, note in state["any_members"]}
+            self.names = {int(uid): name for uid, name in state["names"].items()}
+            self.notified_full = state["notified_full"]
+            self.channel_id = state.get("channel_id")
+            self.message_id = state.get("message_id")
+            self.role_index = {r: i for i, r in enumerate(self.roles)}
+            self.seat_of = {uid: i for i, uid in enumerate(self.seats) if uid is not None}
+            self.build_buttons()
+            return
 
-        author = data["author"]
+        roles = PANEL_ROLES.get(data["type"], PANEL_ROLES["FREE4"])
+        
+        self.roles = list(roles)
+        self.role_index = {r: i for i, r in enumerate(roles)}
+        self.seats = [None] * len(roles)
+        self.seat_of = {}
+        self.any_members = {}
+        self.names = {}
+        self.build_buttons()
+
+        author_id = data["author_id"]
         my_role = data["my_role"]
         
         if my_role and my_role != "None":
             if my_role == "Any":
-                self.any_members.append({"name": author, "note": "主催者(All OK)"})
-            elif my_role in self.members:
-                self.members[my_role] = author
+                self.join_any(author_id, data["author"], "主催者(All OK)")
+            elif my_role in self.role_index:
+                self.take_seat(author_id, data["author"], my_role)
             elif "Tank" in my_role: 
-                if "MT" in self.members: self.members["MT"] = author
+                if "MT" in self.role_index: self.take_seat(author_id, data["author"], "MT")
             elif "参加枠" in my_role:
-                 self.members["参加枠1"] = author
-
-        self.update_buttons()
+                 self.take_seat(author_id, data["author"], "参加枠1")
+
+        self.version = 0
+
+    @classmethod
+    def from_state(cls, cog, panel_id, state):
+        return cls(cog, panel_id, state["data"], state)
+
+    def to_state(self):
+        return {
+            "data": self.data,
+            "roles": self.roles,
+            "seats": self.seats,
+            "any_members": list(self.any_members.items()),
+            "names": self.names,
+            "notified_full": self.notified_full,
+        }
+
+    def save(self):
+        # 作成中（まだ cog に登録していない）パネルは保存しない
+        if self.message_id is not None:
+            self.cog.store.save(self.panel_id, self.to_state())
+
+    def changed(self):
+        # 状態を変えたら必ず呼ぶ（表示は render() でまとめて作る）
+        self.version += 1
+        self.save()
 
     def get_current_count(self):
-        seated_count = sum(1 for u in self.members.values() if u is not None)
-        any_count = len(self.any_members)
-        return seated_count + any_count
-
-    def is_user_joined(self, user_name):
-        in_seat = user_name in self.members.values()
-        in_any = any(m["name"] == user_name for m in self.any_members)
-        return in_seat or in_any
+        return len(self.seat_of) + len(self.any_members)
+
+    def is_user_joined(self, user_id):
+        return user_id in self.seat_of or user_id in self.any_members
+
+    def is_full_for(self, user_id):
+        # 未参加の人から見て満員か（参加済みの人の移動はOK）
+        return not self.is_user_joined(user_id) and self.get_current_count() >= self.max_members
+
+    def display_name(self, user_id):
+        # 名前は表示する時に引く（サーバーのキャッシュに無ければ最後に見た名前）
+        return self.cog.resolve_name(self.channel_id, user_id) or self.names.get(user_id, "???")
+
+    def remove_user(self, user_id):
+        seat = self.seat_of.pop(user_id, None)
+        if seat is not None: self.seats[seat] = None
+        in_any = self.any_members.pop(user_id, None) is not None
+        if seat is None and not in_any: return False
+        self.names.pop(user_id, None)
+        return True
+
+    # --- 状態遷移 ---
+    # チェックから書き換え・保存までを await を挟まずに行う（パネルのロック内で呼ぶ）
+    def take_seat(self, user_id, user_name, role):
+        seat = self.role_index.get(role)
+        if seat is None: return "invalid"
+        if self.seats[seat] not in (None, user_id): return "taken"
+        if self.is_full_for(user_id): return "full"
+        self.remove_user(user_id)
+        self.seats[seat] = user_id
+        self.seat_of[user_id] = seat
+        self.names[user_id] = user_name
+        self.changed()
+        return "ok"
+
+    def join_any(self, user_id, user_name, note):
+        if self.is_full_for(user_id): return "full"
+        self.remove_user(user_id)
+        self.any_members[user_id] = note
+        self.names[user_id] = user_name
+        self.changed()
+        return "ok"
+
+    def leave(self, user_id):
+        if not self.remove_user(user_id): return False
+        self.notified_full = False # 通知リセット
+        self.changed()
+        return True
+
+    def mark_full(self):
+        # ちょうど満員になった時だけ True（通知は1回だけ）
+        if self.notified_full or self.get_current_count() < self.max_members: return False
+        self.notified_full = True
+        self.save()
+        return True
 
     # 満員通知
-    async def check_full_and_notify(self, interaction: discord.Interaction):
-        if self.notified_full: return
-        
-        if self.get_current_count() >= self.max_members:
-            self.notified_full = True
-            author_id = self.data.get("author_id")
-            if author_id:
-                await interaction.channel.send(
-                    f"<@{author_id}> 🎉 **メンバーが満員になりました！**\n出発準備をお願いします！"
-                )
+    async def notify_full(self, interaction: discord.Interaction):
+        # 送信キューに積むだけ（同じパネルの満員通知が重なったら1回にまとめる）
+        author_id = self.data.get("author_id")
+        if author_id:
+            get_outbound().send(
+                interaction.channel,
+                f"<@{author_id}> 🎉 **メンバーが満員になりました！**\n出発準備をお願いします！",
+                priority=HIGH, dedupe=f"full:{self.panel_id}"
+            )
+
+    # --- 表示 ---
+    def build_buttons(self):
+        # ボタンは最初に1回だけ作って、以降は変わったところだけ書き換える
+        self.role_buttons = []
+        for role in self.roles:
+            btn = PanelButton(self.panel_id, f"role:{role}", label=role, style=ROLE_STYLES[role], emoji=ROLE_EMOJIS[role])
+            self.role_buttons.append(btn)
+            self.add_item(btn)
 
-    def update_buttons(self):
-        self.clear_items()
-        
-        current_total = self.get_current_count()
-        is_full = current_total >= self.max_members
+        # 調整枠ボタン
+        self.any_button = PanelButton(self.panel_id, "any", label="調整枠に入る", style=discord.ButtonStyle.secondary, emoji=ROLE_EMOJIS["Any"])
+        self.add_item(self.any_button)
 
-        # 1. ロールボタン
-        for role, user in self.members.items():
-            style = discord.ButtonStyle.secondary
-            disabled = False
-            
-            if user:
-                label = f"{role}: {user}"
-                disabled = True
+        # 離脱ボタン
+        self.add_item(PanelButton(self.panel_id, "leave", label="参加を取り消す", style=discord.ButtonStyle.secondary, emoji="👋", row=4))
+
+        # 削除ボタン
+        self.add_item(PanelButton(self.panel_id, "delete", label="募集を削除", style=discord.ButtonStyle.danger, row=4))
+
+    def visible_key(self):
+        # 見た目を決める要素だけを並べたもの（これが同じなら表示も同じ）
+        return (
+            tuple(self.display_name(u) if u else None for u in self.seats),
+            tuple((self.display_name(u), note) for u, note in self.any_members.items()),
+        )
+
+    def render(self):
+        # 最新の状態をボタンとEmbedに反映して、見た目のキーを返す
+        key = self.visible_key()
+        if key == self.embed_key: return key
+
+        seat_names, _ = key
+        for btn, role, name in zip(self.role_buttons, self.roles, seat_names):
+            if name:
+                label, style, disabled = f"{role}: {name}", discord.ButtonStyle.secondary, True
             else:
-                label = role
-                if role in ["MT", "ST"] or "Tank" in role: style = discord.ButtonStyle.primary
-                elif role in ["H1", "H2"] or "Healer" in role: style = discord.ButtonStyle.success
-                elif "D" in role: style = discord.ButtonStyle.danger
-            
-            emoji = get_emoji_safe(role)
-            btn = Button(label=label, style=style, custom_id=f"rec_{role}", disabled=disabled, emoji=emoji)
-            btn.callback = self.make_role_callback(role)
-            self.add_item(btn)
-        
-        # 2. 調整枠ボタン
-        any_label = "調整枠に入る"
-        if is_full: any_label = "調整枠 (満員)"
-        
-        any_btn = Button(label=any_label, style=discord.ButtonStyle.secondary, custom_id="rec_any", emoji=get_emoji_safe("Any"))
-        any_btn.callback = self.join_any_callback
-        self.add_item(any_btn)
+                label, style, disabled = role, ROLE_STYLES[role], False
+            item = btn.item
+            if item.label != label: item.label = label
+            if item.style != style: item.style = style
+            if item.disabled != disabled: item.disabled = disabled
 
-        # 3. 離脱ボタン
-        leave_btn = Button(label="参加を取り消す", style=discord.ButtonStyle.secondary, custom_id="rec_leave", emoji="👋", row=4)
-        leave_btn.callback = self.leave_callback
-        self.add_item(leave_btn)
+        any_label = "調整枠 (満員)" if self.get_current_count() >= self.max_members else "調整枠に入る"
+        if self.any_button.item.label != any_label: self.any_button.item.label = any_label
 
-        # 4. 削除ボタン
-        cancel = Button(label="募集を削除", style=discord.ButtonStyle.danger, custom_id="rec_delete", row=4)
-        cancel.callback = self.cancel_callback
-        self.add_item(cancel)
+        self.embed = self.build_embed(key)
+        self.embed_key = key
+        return key
+
+    def make_embed(self):
+        self.render()
+        return self.embed
 
     # --- コールバック ---
-    def make_role_callback(self, role):
-        async def cb(interaction: discord.Interaction):
-            try:
-                user_name = interaction.user.display_name
-                if not self.is_user_joined(user_name):
-                    if self.get_current_count() >= self.max_members:
-                        await interaction.response.send_message(f"❌ **満員です！**", ephemeral=True)
-                        return
-
-                for r, u in self.members.items():
-                    if u == user_name: self.members[r] = None
-                self.any_members = [m for m in self.any_members if m["name"] != user_name]
-
-                self.members[role] = user_name
-                self.update_buttons()
-                await interaction.response.edit_message(embed=self.make_embed(), view=self)
-                
-                # 満員チェック
-                await self.check_full_and_notify(interaction)
-                
-            except Exception as e:
-                print(f"❌ Role Error: {e}")
-                traceback.print_exc()
-        return cb
+    async def dispatch(self, interaction: discord.Interaction, action):
+        if action.startswith("role:"):
+            await self.role_callback(interaction, action[len("role:"):])
+        elif action == "any":
+            await self.join_any_callback(interaction)
+        elif action == "leave":
+            await self.leave_callback(interaction)
+        elif action == "delete":
+            await self.cancel_callback(interaction)
+
+    async def role_callback(self, interaction: discord.Interaction, role):
+        try:
+            user = interaction.user
+            async with self.cog.panel_lock(self.panel_id):
+                result = self.take_seat(user.id, user.display_name, role)
+                just_filled = result == "ok" and self.mark_full()
+
+            if result == "full":
+                await interaction.response.send_message(f"❌ **満員です！**", ephemeral=True)
+                return
+            if result == "taken":
+                await interaction.response.send_message("その枠はもう埋まっています！", ephemeral=True)
+                return
+            if result != "ok": return
+
+            await self.cog.publish(interaction, self)
+            
+            # 満員チェック
+            if just_filled: await self.notify_full(interaction)
+            
+        except Exception as e:
+            print(f"❌ Role Error: {e}")
+            traceback.print_exc()
 
     async def join_any_callback(self, interaction: discord.Interaction):
         try:
-            user_name = interaction.user.display_name
-            if not self.is_user_joined(user_name):
-                if self.get_current_count() >= self.max_members:
-                    await interaction.response.send_message(f"❌ **満員です！**", ephemeral=True)
-                    return
-            await interaction.response.send_modal(AnyRoleModal(self, user_name))
+            if self.is_full_for(interaction.user.id):
+                await interaction.response.send_message(f"❌ **満員です！**", ephemeral=True)
+                return
+            await interaction.response.send_modal(AnyRoleModal(self.cog, self.panel_id, interaction.user))
         except Exception as e:
             print(f"❌ Any Error: {e}")
             traceback.print_exc()
 
     async def leave_callback(self, interaction: discord.Interaction):
         try:
-            user_name = interaction.user.display_name
-            removed = False
-            for r, u in self.members.items():
-                if u == user_name:
-                    self.members[r] = None
-                    removed = True
-            original_len = len(self.any_members)
-            self.any_members = [m for m in self.any_members if m["name"] != user_name]
-            if len(self.any_members) < original_len:
-                removed = True
+            async with self.cog.panel_lock(self.panel_id):
+                removed = self.leave(interaction.user.id)
 
             if removed:
-                self.notified_full = False # 通知リセット
-                self.update_buttons()
-                await interaction.response.edit_message(embed=self.make_embed(), view=self)
+                await self.cog.publish(interaction, self)
                 await interaction.followup.send("参加を取り消しました！", ephemeral=True)
             else:
                 await interaction.response.send_message("あなたはまだ参加していません！", ephemeral=True)
@@ -241,9 +437,10 @@ class RecruitmentPanel(View):
 
     # ★修正: 募集削除と同時にスレッドを閉じる
     async def cancel_callback(self, interaction: discord.Interaction):
-        if interaction.user.display_name == self.data["author"]:
+        if interaction.user.id == self.data.get("author_id"):
             # まずパネルを削除済みにする
             await interaction.response.edit_message(content="❌ **募集は削除されました。(スレッドを閉じます)**", embed=None, view=None)
+            self.cog.forget_panel(self.panel_id)
             
             # スレッドならアーカイブしてロックする（お掃除機能）
             if isinstance(interaction.channel, discord.Thread):
@@ -254,8 +451,9 @@ class RecruitmentPanel(View):
         else:
             await interaction.response.send_message("募集主しか削除できません！", ephemeral=True)
 
-    def make_embed(self):
-        total = self.get_current_count()
+    def build_embed(self, key):
+        seat_names, any_rows = key
+        total = sum(1 for n in seat_names if n) + len(any_rows)
         status_text = f"現在の参加者: {total}/{self.max_members}人"
         
         embed = discord.Embed(title=f"⚔️ {self.data['content']}", color=discord.Color.orange())
@@ -269,27 +467,29 @@ class RecruitmentPanel(View):
         )
         embed.description = info_text
 
-        member_text = ""
-        for r, u in self.members.items():
-            icon = get_emoji_safe(r) or "▫️"
-            if u:
-                member_text += f"{icon} **{r}** : **`{u}`**\n"
+        lines = []
+        for r, name in zip(self.roles, seat_names):
+            icon = ROLE_EMOJIS[r] or "▫️"
+            if name:
+                lines.append(f"{icon} **{r}** : **`{name}`**\n")
             else:
-                member_text += f"{icon} {r} : 　\n"
+                lines.append(f"{icon} {r} : 　\n")
 
-        if self.any_members:
-            member_text += "\n**👑 調整・補欠 (Any):**\n"
-            for m in self.any_members:
-                member_text += f"┗ **{m['name']}** ({m['note']})\n"
+        if any_rows:
+            lines.append("\n**👑 調整・補欠 (Any):**\n")
+            for name, note in any_rows:
+                lines.append(f"┗ **{name}** ({note})\n")
 
-        embed.add_field(name="👥 メンバー表", value=member_text, inline=False)
+        embed.add_field(name="👥 メンバー表", value="".join(lines), inline=False)
         embed.set_footer(text=f"主催: {self.data['author']}")
         return embed
 
 # ------------------------------------------------------------------
 # ウィザード
 # ------------------------------------------------------------------
-class ConfirmView(View):
+class ConfirmView(TimedView):
+    component = "pfinder"
+
     def __init__(self, data):
         super().__init__(timeout=180)
         self.data = data
@@ -302,24 +502,31 @@ class ConfirmView(View):
             await interaction.response.send_message("❌ フォーラムIDエラー", ephemeral=True)
             return
 
-        final_view = RecruitmentPanel(self.data)
+        # パネルIDはこのクリックのID（Discordのsnowflakeなので重複しない）
+        cog = interaction.client.get_cog("PartyFinder")
+        final_view = RecruitmentPanel(cog, interaction.id, self.data)
         thread = await channel.create_thread(
             name=f"【募集】{self.data['content']} @{self.data['time']}",
             content=f"📢 **{self.data['content']}** 行くよ！",
             embed=final_view.make_embed(),
             view=final_view
         )
-        
+        cog.add_panel(final_view, thread.thread.id, thread.message.id)
+
+        # 主催者への返事を先に。お知らせは送信キューに積んで後ろで送る
+        await interaction.response.edit_message(content=f"✅ 募集を公開しました！\n{thread.thread.jump_url}", embed=None, view=None)
+
         chat_id = os.getenv("CHAT_CHANNEL_ID")
         role_id = os.getenv("ROLE_ID")
         if chat_id and role_id:
             chat_channel = interaction.guild.get_channel(int(chat_id))
             if chat_channel:
-                await chat_channel.send(
+                get_outbound().send(
+                    chat_channel,
                     f"<@&{role_id}> **{self.data['content']}** の募集が出たよ！\n"
-                    f"参加する人はこっち！ -> {thread.thread.jump_url}"
+                    f"参加する人はこっち！ -> {thread.thread.jump_url}",
+                    priority=LOW, dedupe=f"announce:{final_view.panel_id}"
                 )
-        await interaction.response.edit_message(content=f"✅ 募集を公開しました！\n{thread.thread.jump_url}", embed=None, view=None)
 
     @discord.ui.button(label="❌ やり直す", style=discord.ButtonStyle.red)
     async def cancel(self, interaction: discord.Interaction, button: Button):
@@ -332,6 +539,10 @@ class DetailModal(Modal, title="詳細コメント"):
         self.data = data
 
     async def on_submit(self, interaction: discord.Interaction):
+        with timed(COMPONENT_SECONDS, component="pfinder", action="detail"):
+            await self.submit(interaction)
+
+    async def submit(self, interaction: discord.Interaction):
         self.data["comment"] = self.comment.value
         embed = discord.Embed(title="最終確認", description="公開しますか？", color=discord.Color.blue())
         embed.add_field(name="コンテンツ", value=self.data["content"])
@@ -342,7 +553,9 @@ class DetailModal(Modal, title="詳細コメント"):
         embed.add_field(name="コメント", value=self.data["comment"])
         await interaction.response.edit_message(embed=embed, view=ConfirmView(self.data))
 
-class LocationTimeView(View):
+class LocationTimeView(TimedView):
+    component = "pfinder"
+
     def __init__(self, data):
         super().__init__(timeout=180)
         self.data = data
@@ -363,7 +576,8 @@ class LocationTimeView(View):
         self.add_item(self.dc_select)
 
     def init_date_select(self):
-        today = datetime.date.today()
+        # 開始時刻は日本時間として読むので、「今日」も日本時間で決める（サーバーがUTCでもずれない）
+        today = datetime.datetime.now(JST).date()
         dates = []
         weekdays = ['月','火','水','木','金','土','日']
         for i in range(14):
@@ -435,7 +649,9 @@ class LocationTimeView(View):
         else:
             await interaction.response.edit_message(view=self)
 
-class OwnerRoleSelectView(View):
+class OwnerRoleSelectView(TimedView):
+    component = "pfinder"
+
     def __init__(self, data):
         super().__init__(timeout=180)
         self.data = data
@@ -448,23 +664,25 @@ class OwnerRoleSelectView(View):
             elif "H" in role or "Healer" in role: style = discord.ButtonStyle.success
             elif "D" in role or "DPS" in role: style = discord.ButtonStyle.danger
             
-            emoji = get_emoji_safe(role)
+            emoji = ROLE_EMOJIS[role]
             btn = Button(label=role, style=style, emoji=emoji)
             btn.callback = self.make_callback(role)
             self.add_item(btn)
 
-        any_btn = Button(label="👑 調整 (Any)", style=discord.ButtonStyle.secondary, emoji=get_emoji_safe("Any"), row=2)
+        any_btn = Button(label="👑 調整 (Any)", style=discord.ButtonStyle.secondary, emoji=ROLE_EMOJIS["Any"], row=2)
         any_btn.callback = self.make_callback("Any")
         self.add_item(any_btn)
 
     def make_callback(self, role):
-        async def cb(interaction: discord.Interaction):
+        async def on_owner_role(interaction: discord.Interaction):
             self.data["my_role"] = role
             msg = "あなたは **調整枠** ですね！" if role == "Any" else f"あなたは **{role}** ですね！"
             await interaction.response.edit_message(content=f"{msg}\n次は場所と日時を選んでください。", view=LocationTimeView(self.data))
-        return cb
+        return on_owner_role
+
+class TypeSelectView(TimedView):
+    component = "pfinder"
 
-class TypeSelectView(View):
     def __init__(self, content_name, author_name, author_id):
         super().__init__(timeout=180)
         self.data = {"content": content_name, "author": author_name, "author_id": author_id, "type": None, "my_role": "None"}
@@ -486,6 +704,223 @@ class TypeSelectView(View):
 class PartyFinder(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # リロードの時はDB接続とスケジューラーを前のCogから引き継ぐ
+        state = take_snapshot(self)
+        self.store = state["store"] if state else PanelStore()
+        # 最近触られたパネルだけメモリに置く（古いものは押された時にDBから読み直す）
+        self.panels = OrderedDict()
+        self.locks = {}
+        self.render_tasks = {} # {panel_id: まとめて編集するタスク}
+        # !reload の引き継ぎ中は新しい操作を断り、処理中の操作（ロック〜表示更新まで）が終わるのを待つ
+        self.handing_over = False
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # 開始前のお知らせ・終了後のお片付け（全パネル分をこれ1つで待つ）
+        self.scheduler = state["scheduler"] if state else Scheduler()
+        self.scheduler.register("remind", self.remind_panel)
+        self.scheduler.register("archive", self.archive_panel)
+        # メモリにあったパネルは新しいクラスで作り直す（編集待ちだったものは続きを出す）
+        self.pending_renders = []
+        if state:
+            for panel_id, panel_state in state["panels"]:
+                self.cache_panel(RecruitmentPanel.from_state(self, panel_id, panel_state))
+            self.pending_renders = state["pending"]
+
+    async def cog_load(self):
+        # 止まっている間に期限が来たお知らせ・お片付けはすぐ動くので、ログインが終わってから始める
+        self.scheduler_starter = asyncio.create_task(self.start_scheduler())
+        registry.register_collector("partyfinder", self.collect_metrics)
+        for panel_id in self.pending_renders:
+            self.render_tasks[panel_id] = asyncio.create_task(self.render_later(panel_id))
+        self.pending_renders = []
+
+    async def export_state(self):
+        # 処理中の参加・取り消しが終わってから写す（後から終わった変更が古い写しで上書きされないように）
+        self.handing_over = True
+        try:
+            await asyncio.wait_for(self.idle.wait(), HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ PartyFinder: 処理中の操作が{HANDOFF_TIMEOUT}秒で終わらないまま引き継ぎます")
+        panels = [(pid, dict(p.to_state(), channel_id=p.channel_id, message_id=p.message_id)) for pid, p in self.panels.items()]
+        return {"store": self.store, "scheduler": self.scheduler, "panels": panels, "pending": list(self.render_tasks)}
+
+    def collect_metrics(self):
+        registry.gauge("partyfinder_open_panels", "Recruitment panels still open").set(self.store.count())
+        registry.gauge("partyfinder_cached_panels", "Recruitment panels kept in memory").set(len(self.panels))
+        registry.gauge("partyfinder_pending_renders", "Panel edits waiting to be flushed").set(len(self.render_tasks))
+        registry.gauge("scheduler_jobs", "Scheduled reminder/archive jobs").set(len(self.scheduler))
+
+    async def start_scheduler(self):
+        await self.bot.wait_until_ready()
+        self.scheduler.start()
+
+    async def cog_unload(self):
+        self.scheduler_starter.cancel()
+        registry.unregister_collector("partyfinder")
+        self.bot.remove_dynamic_items(PanelButton)
+        for task in self.render_tasks.values(): task.cancel()
+        if handing_off(self): return
+        self.scheduler.stop()
+        self.store.close()
+
+    def cache_panel(self, panel):
+        self.panels[panel.panel_id] = panel
+        self.panels.move_to_end(panel.panel_id)
+        # 古い順に追い出す（処理中のパネルは追い出さない）
+        while len(self.panels) > PANEL_CACHE_SIZE:
+            victim = next((pid for pid in self.panels if pid not in self.locks and pid not in self.render_tasks), None)
+            if victim is None: break
+            del self.panels[victim]
+
+    @asynccontextmanager
+    async def panel_lock(self, panel_id):
+        # パネルごとのロック {panel_id: [lock, 使用中の数]}（誰も使っていなければ消す）
+        entry = self.locks.get(panel_id)
+        if entry is None:
+            entry = self.locks[panel_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.locks[panel_id]
+
+    def add_panel(self, panel, channel_id, message_id):
+        panel.channel_id, panel.message_id = channel_id, message_id
+        panel.shown_key = panel.render()
+        self.store.save(panel.panel_id, panel.to_state(), channel_id, message_id)
+        self.cache_panel(panel)
+        self.schedule_panel(panel)
+
+    def schedule_panel(self, panel):
+        start = parse_start_time(panel.data.get("time"))
+        if start is None: return
+        key = str(panel.panel_id)
+        now = time.time()
+        if start - RECRUIT_REMIND_BEFORE > now:
+            self.scheduler.add(start - RECRUIT_REMIND_BEFORE, "remind", key)
+        # 開始時刻がずっと前になっている募集（日付の選び間違いなど）を、出した直後に閉じないように
+        self.scheduler.add(max(start, now) + RECRUIT_ARCHIVE_AFTER, "archive", key)
+
+    async def get_thread(self, panel):
+        return self.bot.get_channel(panel.channel_id) or await self.bot.fetch_channel(panel.channel_id)
+
+    async def remind_panel(self, key, payload):
+        panel = self.get_panel(int(key))
+        if panel is None or panel.channel_id is None: return
+        # 止まっている間に開始時刻を過ぎていたら、今さら「あと15分」とは言わない
+        start = parse_start_time(panel.data.get("time"))
+        if start is None or time.time() >= start: return
+        user_ids = [u for u in panel.seats if u] + list(panel.any_members)
+        if not user_ids: return
+        mentions = " ".join(f"<@{u}>" for u in user_ids)
+        minutes = int(RECRUIT_REMIND_BEFORE // 60)
+        thread = await self.get_thread(panel)
+        get_outbound().send(thread, f"{mentions}\n⏰ **{panel.data['content']}** はあと{minutes}分で開始だよ！準備してね！", priority=NORMAL, dedupe=f"remind:{key}")
+
+    async def archive_panel(self, key, payload):
+        panel = self.get_panel(int(key))
+        if panel is None or panel.channel_id is None: return
+        # スレッドを閉じられてから忘れる（失敗したらスケジューラーがやり直す）
+        try:
+            thread = await self.get_thread(panel)
+        except discord.NotFound:
+            thread = None # スレッドごと消されている
+        if isinstance(thread, discord.Thread):
+            await thread.edit(archived=True, locked=True)
+        self.forget_panel(panel.panel_id)
+
+    def get_panel(self, panel_id):
+        panel = self.panels.get(panel_id)
+        if panel is None:
+            state = self.store.load(panel_id)
+            if state is None: return None
+            panel = RecruitmentPanel.from_state(self, panel_id, state)
+        self.cache_panel(panel)
+        return panel
+
+    def resolve_name(self, channel_id, user_id):
+        channel = self.bot.get_channel(channel_id) if channel_id else None
+        member = channel.guild.get_member(user_id) if channel else None
+        return member.display_name if member else None
+
+    def forget_panel(self, panel_id):
+        self.panels.pop(panel_id, None)
+        self.scheduler.cancel(str(panel_id))
+        task = self.render_tasks.pop(panel_id, None)
+        if task: task.cancel()
+        self.store.delete(panel_id)
+
+    @asynccontextmanager
+    async def handling(self):
+        # パネルを書き換える操作はこの中で行う（引き継ぎの時に終わるのを待つため）
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0: self.idle.set()
+
+    async def refuse_during_handoff(self, interaction):
+        if not self.handing_over: return False
+        await interaction.response.send_message("ちょっとだけメンテナンス中！数秒後にもう一回押してね！", ephemeral=True)
+        return True
+
+    async def dispatch_panel(self, interaction: discord.Interaction, panel_id, action):
+        if await self.refuse_during_handoff(interaction): return
+        async with self.handling():
+            panel = self.get_panel(panel_id)
+            if panel is None:
+                await interaction.response.send_message("この募集はもう終了しています。", ephemeral=True)
+                return
+            if panel.message_id is None and interaction.message:
+                panel.channel_id, panel.message_id = interaction.channel_id, interaction.message.id
+            await panel.dispatch(interaction, action)
+
+    # --- パネルの表示更新 ---
+    # 連打された時は、最初の1回だけすぐ編集して、残りは少し待ってから最新の状態で1回にまとめる
+    async def publish(self, interaction: discord.Interaction, panel):
+        pending = panel.panel_id in self.render_tasks
+        key = panel.render()
+        if key == panel.shown_key and not pending:
+            # 見た目が変わっていなければ編集しない
+            await interaction.response.defer()
+        elif not pending and time.monotonic() - panel.last_edit >= PANEL_EDIT_DELAY:
+            async with panel.edit_lock:
+                panel.last_edit = time.monotonic()
+                panel.shown_key = key
+                await interaction.response.edit_message(embed=panel.embed, view=panel)
+        else:
+            await interaction.response.defer()
+            if not pending:
+                self.render_tasks[panel.panel_id] = asyncio.create_task(self.render_later(panel.panel_id))
+
+    async def render_later(self, panel_id):
+        try:
+            while True:
+                await asyncio.sleep(PANEL_EDIT_DELAY)
+                panel = self.get_panel(panel_id)
+                if panel is None or panel.message_id is None: return
+                async with panel.edit_lock:
+                    version = panel.version
+                    key = panel.render()
+                    if key != panel.shown_key:
+                        panel.last_edit = time.monotonic()
+                        panel.shown_key = key
+                        message = self.bot.get_partial_messageable(panel.channel_id).get_partial_message(panel.message_id)
+                        await message.edit(embed=panel.embed, view=panel)
+                # 編集している間にまた変わっていたら、もう1回だけ
+                if panel.version == version: return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Panel Render Error: {e}")
+        finally:
+            self.render_tasks.pop(panel_id, None)
     
     @app_commands.command(name="pfinder", description="募集を作成します（非公開で作成）")
     @app_commands.rename(content_name="コンテンツ名") 
@@ -497,4 +932,6 @@ class PartyFinder(commands.Cog):
         )
 
 async def setup(bot):
+    # 募集パネルのボタンはこのクラス1つで全パネル分を受け付ける
+    bot.add_dynamic_items(PanelButton)
     await bot.add_cog(PartyFinder(bot))
\ No newline at end of file
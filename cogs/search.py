@@ -1,45 +1,150 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-from duckduckgo_search import DDGS
-import google.generativeai as genai
+import asyncio
+import math
 import os
+import time
+from collections import deque
+from hot_reload import take_snapshot, handing_off
+from llm import get_router, estimate_tokens, LLM_BUDGETS
+from search_cache import SearchCache
+from metrics import SEARCH_SECONDS
+from quota import get_quotas
+
+# Botに必要な設定（スラッシュコマンドだけなので guilds のみ）
+PROFILE = {"intents": ["guilds"]}
+
+# 検索パイプラインの設定
+# 複数のクエリ/リージョンを同時に検索して、URLで重複を除いてから要約する
+SEARCH_VARIANTS = os.getenv("SEARCH_VARIANTS", "{query} FF14").split("|")
+SEARCH_REGIONS = os.getenv("SEARCH_REGIONS", "jp-jp").split(",")
+SEARCH_PER_VARIANT = int(os.getenv("SEARCH_PER_VARIANT", "3"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "3"))
+SEARCH_FETCH_TIMEOUT = float(os.getenv("SEARCH_FETCH_TIMEOUT", "8"))
+SEARCH_SUMMARY_TIMEOUT = float(os.getenv("SEARCH_SUMMARY_TIMEOUT", "30"))
+
+# 毎回同じ指示はシステムプロンプトにする（使えるモデルではモデルごと作り置きされる）
+SEARCH_SYSTEM_PROMPT = """
+ユーザーの質問に対し、渡された検索結果を元にFF14プレイヤー向けに要約してください。
+もし検索結果がFF14と全く無関係なら「FF14に関する情報はなさそうです」と答えてください。
+"""
+
+def merge_results(result_lists, limit):
+    # 各検索の上位から順番に拾っていく（同じURLは1回だけ）
+    merged, seen = [], set()
+    for rank in range(max((len(r) for r in result_lists), default=0)):
+        for results in result_lists:
+            if rank >= len(results): continue
+            r = results[rank]
+            if r["href"] in seen: continue
+            seen.add(r["href"])
+            merged.append(r)
+    return merged[:limit]
+
+def format_results(results):
+    return "".join(f"Title: {r['title']}\nURL: {r['href']}\nSummary: {r['body']}\n---\n" for r in results)
+
+def fit_results(results, budget):
+    # 上限を超える場合は、順位の低い結果から外す（1件だけでも超えるなら本文を切り詰める）
+    results = list(results)
+    while len(results) > 1 and estimate_tokens(format_results(results)) > budget:
+        results.pop()
+    text = format_results(results)
+    if estimate_tokens(text) > budget:
+        text = text[:budget]
+    return text
 
 class Search(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        try:
-            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-            self.model = genai.GenerativeModel('gemini-1.5-flash')
-        except: pass
+        self.router = get_router()
+        self.quotas = get_quotas()
+        # リロードの時はキャッシュと計測値を前のCogから引き継ぐ
+        state = take_snapshot(self)
+        if state:
+            self.cache, self.latencies = state["cache"], state["latencies"]
+        else:
+            self.cache = SearchCache()
+            self.latencies = {"fetch": deque(maxlen=100), "summarize": deque(maxlen=100)} # ステージごとの所要時間(ms)
 
     @app_commands.command(name="search", description="Webを検索してFF14の情報を探します")
     async def search(self, interaction: discord.Interaction, query: str):
+        # 使いすぎ防止（1人・1サーバーあたりの回数制限）
+        wait = self.quotas.check("search", interaction.user.id, interaction.guild_id)
+        if wait:
+            await interaction.response.send_message(f"ちょっと検索しすぎかも！あと{math.ceil(wait)}秒待ってからもう一回試してね！", ephemeral=True)
+            return
         await interaction.response.defer(ephemeral=True)
         try:
-            results_text = ""
-            with DDGS() as ddgs:
-                results = list(ddgs.text(f"{query} FF14", region='jp-jp', max_results=3))
-                for r in results:
-                    results_text += f"Title: {r['title']}\nURL: {r['href']}\nSummary: {r['body']}\n---\n"
+            # 検索結果（同じクエリはキャッシュ / 同時に来たら1回だけ検索）
+            results = await self.cache.get_results(query, lambda: self.fetch_results(query))
 
-            if not results_text:
+            if not results:
                 await interaction.followup.send("ごめん、それっぽい情報が見つからなかった…", ephemeral=True)
                 return
 
-            prompt = f"""
-            ユーザーの質問「{query}」に対し、以下の検索結果を元にFF14プレイヤー向けに要約してください。
-            もし検索結果がFF14と全く無関係なら「FF14に関する情報はなさそうです」と答えてください。
-            
-            検索結果:
-            {results_text}
-            """
-            response = self.model.generate_content(prompt)
-            await interaction.followup.send(f"🔍 **「{query}」の検索結果**\n{response.text}", ephemeral=True)
+            # 要約（クエリ + 検索結果が同じなら使い回す）
+            summary = await self.cache.get_summary(query, results, lambda: self.summarize(query, results, interaction.user.id))
+            await interaction.followup.send(f"🔍 **「{query}」の検索結果**\n{summary}", ephemeral=True)
+
+        except asyncio.TimeoutError:
+            print(f"⏱️ Search Timeout: {query}")
+            await interaction.followup.send("ごめん、検索に時間がかかりすぎちゃった…もう一回試してみて！", ephemeral=True)
 
         except Exception as e:
             print(e)
             await interaction.followup.send("検索エラーが発生しました。", ephemeral=True)
 
+    def record(self, stage, started):
+        seconds = time.perf_counter() - started
+        SEARCH_SECONDS.observe(seconds, stage=stage)
+        ms = seconds * 1000
+        self.latencies[stage].append(ms)
+        print(f"🔍 search {stage}: {ms:.0f}ms")
+
+    def fetch_one(self, text, region):
+        # DDGSは同期APIなのでスレッドで呼ぶ（ライブラリも最初に使う時に読み込む）
+        from duckduckgo_search import DDGS
+        with DDGS() as ddgs:
+            results = list(ddgs.text(text, region=region, max_results=SEARCH_PER_VARIANT))
+        return [{"title": r['title'], "href": r['href'], "body": r['body']} for r in results]
+
+    async def fetch_results(self, query):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        jobs = [
+            asyncio.wait_for(loop.run_in_executor(None, self.fetch_one, variant.format(query=query), region), SEARCH_FETCH_TIMEOUT)
+            for variant in SEARCH_VARIANTS for region in SEARCH_REGIONS
+        ]
+        outcomes = await asyncio.gather(*jobs, return_exceptions=True)
+        result_lists = [o for o in outcomes if not isinstance(o, BaseException)]
+        self.record("fetch", started)
+
+        # 全部失敗した時だけエラー扱い（一部失敗なら取れた分で要約する）
+        if not result_lists:
+            raise outcomes[0]
+        return merge_results(result_lists, SEARCH_MAX_RESULTS)
+
+    async def summarize(self, query, results, user_id=None):
+        query_part = f"質問: {query}\n\n検索結果:\n"
+        results_text = fit_results(results, LLM_BUDGETS["search"] - estimate_tokens(SEARCH_SYSTEM_PROMPT + query_part))
+        prompt = query_part + results_text
+
+        started = time.perf_counter()
+        try:
+            response, _ = await asyncio.wait_for(self.router.generate("search", prompt, SEARCH_SYSTEM_PROMPT, user_id=user_id), SEARCH_SUMMARY_TIMEOUT)
+            # 応答の取り出しも try の中で（finally では時間の記録だけにして、元のエラーを隠さない）
+            text = response.text
+        finally:
+            self.record("summarize", started)
+        return text
+
+    def export_state(self):
+        return {"cache": self.cache, "latencies": self.latencies}
+
+    async def cog_unload(self):
+        if not handing_off(self): self.cache.close()
+
 async def setup(bot):
     await bot.add_cog(Search(bot))
\ No newline at end of file
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import discord
+
+# ------------------------------------------------------------------
+# スラッシュコマンドの自動同期
+# コマンド定義（名前・オプション・説明など）からハッシュを作って、
+# 前回同期した時と変わっている時だけ同期する（無駄なAPI呼び出しをしない）
+# DEV_GUILD_ID を指定すると、そのサーバーにだけ即時反映する（開発用）
+# ------------------------------------------------------------------
+SYNC_STATE_FILE = "data/command_sync.json"
+AUTO_SYNC = os.getenv("AUTO_SYNC", "1") != "0"
+DEV_GUILD_ID = os.getenv("DEV_GUILD_ID")
+
+def tree_fingerprint(tree, guild=None):
+    payload = [cmd.to_dict(tree) for cmd in tree.get_commands(guild=guild)]
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def load_state():
+    if not os.path.exists(SYNC_STATE_FILE): return {}
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    if not os.path.exists(os.path.dirname(SYNC_STATE_FILE)): os.makedirs(os.path.dirname(SYNC_STATE_FILE))
+    tmp = SYNC_STATE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp, SYNC_STATE_FILE)
+
+async def sync_commands(bot, guild_id=None, force=False):
+    # 同期したら同期したコマンド数、変更なしでスキップしたら None を返す
+    tree = bot.tree
+    guild = discord.Object(id=int(guild_id)) if guild_id else None
+    if guild:
+        tree.copy_global_to(guild=guild)
+    scope = f"guild:{guild_id}" if guild else "global"
+
+    fingerprint = tree_fingerprint(tree, guild)
+    state = load_state()
+    if not force and state.get(scope) == fingerprint:
+        return None
+
+    synced = await tree.sync(guild=guild)
+    state[scope] = fingerprint
+    save_state(state)
+    return len(synced)
+
+async def auto_sync(bot):
+    if not AUTO_SYNC: return
+    targets = [DEV_GUILD_ID] if DEV_GUILD_ID else [None]
+    for guild_id in targets:
+        scope = f"サーバー {guild_id}" if guild_id else "グローバル"
+        try:
+            count = await sync_commands(bot, guild_id)
+        except discord.HTTPException as e:
+            print(f"⚠️ コマンド同期エラー ({scope}): {e}")
+            continue
+        if count is None:
+            print(f"✅ コマンド定義に変更なし ({scope}) - 同期をスキップしました")
+        else:
+            print(f"🔄 {count} 個のコマンドを同期しました ({scope})")
@@ -0,0 +1,45 @@
+import inspect
+import time
+
+# ------------------------------------------------------------------
+# 状態を引き継いだままCogを入れ替える（プロセスの再起動・再接続なし）
+# 引き継ぎたい状態がある Cog は次の2つを用意する。
+#   export_state(self) -> dict   ... 外す直前に呼ばれる（DB接続などもそのまま渡してよい）
+#                                    処理中のものを待ってから渡したい場合は async def でもよい
+#   take_snapshot(self)          ... 新しいCogの __init__ で呼んで、渡された状態を受け取る
+# 渡したものは新しいCogが使うので、古いCogの cog_unload では
+# handing_off(self) が True の間は閉じないこと。
+# ------------------------------------------------------------------
+
+def extension_name(name):
+    return name if name.startswith("cogs.") else f"cogs.{name}"
+
+def handing_off(cog):
+    return cog.qualified_name in getattr(cog.bot, "cog_snapshots", {})
+
+def take_snapshot(cog):
+    snapshots = getattr(cog.bot, "cog_snapshots", None)
+    if not snapshots: return None
+    return snapshots.pop(cog.qualified_name, None)
+
+async def reload_with_state(bot, name):
+    # 戻り値は入れ替えにかかった秒数
+    # 読み込みに失敗した場合は discord.py が古いモジュールに戻す（その時も状態は引き継がれる）
+    if not hasattr(bot, "cog_snapshots"): bot.cog_snapshots = {}
+    started = time.perf_counter()
+    exported = []
+    for cog in list(bot.cogs.values()):
+        export = getattr(cog, "export_state", None)
+        if cog.__module__ != name or export is None: continue
+        state = export()
+        if inspect.isawaitable(state): state = await state
+        bot.cog_snapshots[cog.qualified_name] = state
+        exported.append(cog.qualified_name)
+    try:
+        await bot.reload_extension(name)
+    finally:
+        # 受け取られなかった状態は捨てる（Cog名が変わった場合など）
+        for cog_name in exported:
+            if bot.cog_snapshots.pop(cog_name, None) is not None:
+                print(f"⚠️ Reload: {cog_name} の状態は引き継がれませんでした")
+    return time.perf_counter() - started
@@ -1,15 +1,75 @@
-from flask import Flask
-from threading import Thread
-
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "I'm alive"
-
-def run():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
\ No newline at end of file
+import math
+import os
+import time
+from aiohttp import web
+from llm import llm_health
+from metrics import registry
+from startup import DISABLED_EXTENSIONS
+
+# ------------------------------------------------------------------
+# 死活監視・計測用のHTTPサーバー
+# Botと同じイベントループで動くので、スレッドは増えないし、Botの状態をそのまま見られる。
+# Botを止める時は stop() で一緒に閉じる。
+#   /        生きているか（プロセスが動いていれば200）
+#   /ready   ちゃんと使える状態か（Gatewayに繋がっていて、Cogが全部読み込めているか）
+#   /metrics 計測値（Prometheus形式）
+# ------------------------------------------------------------------
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("PORT", "8080"))
+READY_MAX_LATENCY = float(os.getenv("READY_MAX_LATENCY", "5")) # これ以上Gatewayが遅いと ready にしない(秒)
+
+class HealthServer:
+    def __init__(self, bot, extensions, host=HEALTH_HOST, port=HEALTH_PORT):
+        self.bot = bot
+        self.extensions = extensions
+        self.host = host
+        self.port = port
+        self.started = time.time()
+        self.runner = None
+        app = web.Application()
+        app.router.add_get("/", self.home)
+        app.router.add_get("/ready", self.ready)
+        app.router.add_get("/metrics", self.metrics)
+        self.app = app
+
+    async def home(self, request):
+        return web.Response(text="I'm alive")
+
+    def status(self):
+        latency = self.bot.latency
+        missing = [name for name in self.extensions if name not in self.bot.extensions]
+        # AutoShardedBot なら全シャード分、普通の Bot は1本だけ
+        shards = getattr(self.bot, "latencies", [(self.bot.shard_id or 0, latency)])
+        gateway = self.bot.is_ready() and not self.bot.is_closed() and math.isfinite(latency) and latency < READY_MAX_LATENCY
+        return {
+            "ready": gateway and not missing,
+            "gateway": {
+                "connected": self.bot.is_ready() and not self.bot.is_closed(),
+                "latency": round(latency, 3) if math.isfinite(latency) else None,
+                "shards": {str(shard_id): round(shard_latency, 3) for shard_id, shard_latency in shards if math.isfinite(shard_latency)},
+            },
+            "cogs": {"loaded": sorted(self.bot.cogs), "missing_extensions": missing, "disabled_extensions": DISABLED_EXTENSIONS},
+            "llm": llm_health(),
+            "uptime": round(time.time() - self.started),
+            # 起動から最初の on_ready までの秒数（まだなら null）
+            "startup_seconds": round(self.bot.startup_seconds, 2) if getattr(self.bot, "startup_seconds", None) is not None else None,
+        }
+
+    async def ready(self, request):
+        # LLMの調子が悪くてもBot自体は動けるので、ready には含めず中身で知らせる
+        status = self.status()
+        return web.json_response(status, status=200 if status["ready"] else 503)
+
+    async def metrics(self, request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        print(f"🩺 ヘルスチェック: http://{self.host}:{self.port}/ (/ready, /metrics)")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
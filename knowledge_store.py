@@ -0,0 +1,154 @@
+import json
+import os
+
+# ------------------------------------------------------------------
+# マクロ・攻略ボードの保存エンジン
+# 変更は1件ずつログに追記して（fsync付き）、たまにスナップショットへまとめる。
+# スナップショットは一時ファイルに書いてから rename するので、途中で落ちても壊れない。
+# ------------------------------------------------------------------
+KNOWLEDGE_BACKEND = os.getenv("KNOWLEDGE_BACKEND", "log") # "log" or "json"
+KNOWLEDGE_DIR = "data"
+LEGACY_FILE = os.path.join(KNOWLEDGE_DIR, "knowledge.json")
+SNAPSHOT_FILE = os.path.join(KNOWLEDGE_DIR, "knowledge.snapshot.json")
+LOG_FILE = os.path.join(KNOWLEDGE_DIR, "knowledge.log")
+COMPACT_EVERY = int(os.getenv("KNOWLEDGE_COMPACT_EVERY", "200")) # ログがこの件数を超えたらまとめる
+NAMESPACES = ("macros", "strategies")
+
+def empty_data():
+    return {ns: {} for ns in NAMESPACES}
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    for ns in NAMESPACES: data.setdefault(ns, {})
+    return data
+
+def write_json_atomic(path, data, indent=None):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class KnowledgeStore:
+    # 保存エンジンの共通部分（読み取りだけ）。upsert(ns, key, value) / delete(ns, key) は各エンジンで持つ
+    # data は {"macros": {名前: 内容}, "strategies": {名前: コード}} （読み取り専用として使うこと）
+    def __init__(self):
+        self.data = empty_data()
+
+    def get(self, ns, key, default=None):
+        return self.data[ns].get(key, default)
+
+    def keys(self, ns):
+        return self.data[ns].keys()
+
+    def close(self):
+        pass
+
+
+class AppendLogStore(KnowledgeStore):
+    def __init__(self, snapshot_file=SNAPSHOT_FILE, log_file=LOG_FILE, legacy_file=LEGACY_FILE, compact_every=COMPACT_EVERY):
+        super().__init__()
+        self.snapshot_file = snapshot_file
+        self.log_file = log_file
+        self.compact_every = compact_every
+        if not os.path.exists(os.path.dirname(snapshot_file)): os.makedirs(os.path.dirname(snapshot_file))
+
+        if os.path.exists(snapshot_file):
+            self.data = read_json(snapshot_file)
+        elif os.path.exists(legacy_file):
+            # 初回だけ旧 knowledge.json を取り込む
+            self.data = read_json(legacy_file)
+            write_json_atomic(snapshot_file, self.data)
+            print(f"📦 Knowledge: {legacy_file} を取り込みました")
+
+        self.log_count, damaged = self.replay()
+        if damaged:
+            # 壊れた行のあとに追記すると次の行とくっついて読めなくなるので、
+            # 読めた分をスナップショットにまとめて、ログを空からやり直す
+            write_json_atomic(snapshot_file, self.data)
+            open(log_file, "w", encoding="utf-8").close()
+            self.log_count = 0
+            print("🧹 Knowledge: 壊れたログ行があったのでスナップショットにまとめ直しました")
+        self.log = open(log_file, "a", encoding="utf-8")
+
+    def replay(self):
+        # (読めた件数, 壊れた行があったか) を返す
+        if not os.path.exists(self.log_file): return 0, False
+        count = 0
+        damaged = False
+        with open(self.log_file, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # 改行まで書けていない行 = 書き込み途中で落ちた（中身が読めても後で書き直す）
+                    damaged = True
+                try:
+                    rec = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    print("⚠️ Knowledge: 壊れたログ行をスキップしました")
+                    damaged = True
+                    continue
+                if rec["op"] == "set":
+                    self.data[rec["ns"]][rec["key"]] = rec["value"]
+                else:
+                    self.data[rec["ns"]].pop(rec["key"], None)
+                count += 1
+        return count, damaged
+
+    def append(self, rec):
+        self.log.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_count += 1
+        if self.log_count >= self.compact_every:
+            self.compact()
+
+    def upsert(self, ns, key, value):
+        self.data[ns][key] = value
+        self.append({"op": "set", "ns": ns, "key": key, "value": value})
+
+    def delete(self, ns, key):
+        if key not in self.data[ns]: return False
+        del self.data[ns][key]
+        self.append({"op": "del", "ns": ns, "key": key})
+        return True
+
+    def compact(self):
+        # スナップショットを書いてからログを空にする
+        # （間で落ちてもログを再適用するだけなので結果は同じ）
+        write_json_atomic(self.snapshot_file, self.data)
+        self.log.close()
+        self.log = open(self.log_file, "w", encoding="utf-8")
+        self.log_count = 0
+
+    def close(self):
+        self.compact()
+        self.log.close()
+
+
+class JsonFileStore(KnowledgeStore):
+    # 旧方式（毎回ファイル全体を書き直す）。件数が少ないうちはこれでも十分
+    def __init__(self, path=LEGACY_FILE):
+        super().__init__()
+        self.path = path
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            self.data = read_json(path)
+
+    def upsert(self, ns, key, value):
+        self.data[ns][key] = value
+        write_json_atomic(self.path, self.data, indent=4)
+
+    def delete(self, ns, key):
+        if key not in self.data[ns]: return False
+        del self.data[ns][key]
+        write_json_atomic(self.path, self.data, indent=4)
+        return True
+
+
+def make_store(backend=KNOWLEDGE_BACKEND):
+    if backend == "json":
+        return JsonFileStore()
+    return AppendLogStore()
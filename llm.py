@@ -0,0 +1,475 @@
+import asyncio
+import functools
+import os
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from metrics import registry, LLM_SECONDS, LLM_TOKENS
+from quota import FairLimiter
+
+_DONE = object()
+
+# ------------------------------------------------------------------
+# LLM呼び出し用の実行レイヤー
+# Gemini SDKは同期APIなので、そのまま呼ぶとイベントループ全体が止まる。
+# ここでスレッドプールに逃がして、全体の同時実行数とタイムアウトを管理する。
+# ------------------------------------------------------------------
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# 1回の呼び出しで送るプロンプトの上限トークン（超える分は履歴や検索結果を削って収める）
+LLM_BUDGETS = {
+    "chat": int(os.getenv("LLM_BUDGET_CHAT", "8000")),
+    "search": int(os.getenv("LLM_BUDGET_SEARCH", "2000")),
+}
+
+
+class LLMPool:
+    def __init__(self, concurrency=LLM_CONCURRENCY, timeout=LLM_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm")
+        # 全体の同時実行数の上限。いっぱいの時は人ごとに順番に通す（1人が連投しても他の人を待たせない）
+        self.limiter = FairLimiter(concurrency)
+        self.concurrency = concurrency
+        self.active = 0 # 実行中の呼び出し数（ヘルスチェック用）
+        self.timeout = timeout
+        # ユーザーごとのロック {user_id: [lock, 使用中の数]}
+        # 誰も使っていないロックは消すので、話した人数分だけ増え続けることはない
+        self.user_locks = {}
+
+    @asynccontextmanager
+    async def user_slot(self, user_id):
+        # 同じユーザーのリクエストは順番に（同じ会話履歴を同時にいじらないように）
+        # 履歴の読み込み～保存までまとめて守りたい場合に、呼び出し側で使う
+        if user_id is None:
+            yield
+            return
+        entry = self.user_locks.get(user_id)
+        if entry is None:
+            entry = self.user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.user_locks[user_id]
+
+    async def submit(self, user_id, func):
+        # 枠を取ってからワーカースレッドに渡す。user_id は順番待ちの公平さのため（None なら「その他」でまとめて並ぶ）
+        # 枠はスレッドが本当に終わった時に返す（タイムアウトで先に返すと、動いているスレッドが上限を超えてしまう）
+        await self.limiter.acquire(user_id)
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func)
+        self.active += 1
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        self.active -= 1
+        self.limiter.release()
+        if not future.cancelled(): future.exception() # 誰も結果を見なかった時の警告を出さない
+
+    async def run(self, user_id, func, *args, **kwargs):
+        future = await self.submit(user_id, functools.partial(func, *args, **kwargs))
+        # タイムアウトしてもスレッド自体は止められないが、ユーザーは待たせない（枠はスレッドが終わるまで使ったまま）
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    async def stream(self, user_id, func, *args, **kwargs):
+        # func が返すイテレータ（ストリーミング応答）をワーカースレッドで回して、
+        # 届いたチャンクを順番に yield する。タイムアウトはチャンク間の待ち時間に対してかかる
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for chunk in func(*args, **kwargs):
+                    if stopped.is_set(): return
+                    loop.call_soon_threadsafe(queue.put_nowait, (chunk, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (_DONE, e))
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, (_DONE, None))
+
+        # 枠は produce が終わった時に返る（途中で止めても、スレッドが次のチャンクを受け取って抜けるまでは使用中）
+        await self.submit(user_id, produce)
+        try:
+            while True:
+                chunk, error = await asyncio.wait_for(queue.get(), self.timeout)
+                if chunk is _DONE:
+                    if error: raise error
+                    return
+                yield chunk
+        finally:
+            # 途中で止めた場合はスレッド側にも読むのをやめさせる
+            stopped.set()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ------------------------------------------------------------------
+# LLM呼び出しの記録（機能・モデルごとに、トークン数と所要時間を集計する）
+# 管理者用の !llmstats で見られる
+# ------------------------------------------------------------------
+class UsageStats:
+    def __init__(self, samples=200):
+        self.samples = samples
+        self.rows = {} # {(機能, モデル): 集計}
+        self.recent = deque(maxlen=20) # 直近の呼び出しが成功したか（ヘルスチェック用）
+        self.started = time.time()
+
+    def record(self, feature, model, prompt_tokens, response_tokens, seconds, ok=True):
+        row = self.rows.get((feature, model))
+        if row is None:
+            row = self.rows[(feature, model)] = {
+                "calls": 0, "errors": 0, "prompt_tokens": 0, "response_tokens": 0,
+                "max_prompt": 0, "latencies": deque(maxlen=self.samples),
+            }
+        row["calls"] += 1
+        if not ok: row["errors"] += 1
+        row["prompt_tokens"] += prompt_tokens
+        row["response_tokens"] += response_tokens
+        row["max_prompt"] = max(row["max_prompt"], prompt_tokens)
+        row["latencies"].append(seconds)
+        self.recent.append(ok)
+        LLM_SECONDS.observe(seconds, feature=feature, model=model, status="ok" if ok else "error")
+        LLM_TOKENS.inc(prompt_tokens, feature=feature, model=model, direction="prompt")
+        LLM_TOKENS.inc(response_tokens, feature=feature, model=model, direction="response")
+
+    def summary(self):
+        lines = []
+        for (feature, model), row in sorted(self.rows.items()):
+            latencies = sorted(row["latencies"])
+            p50 = statistics.median(latencies) if latencies else 0.0
+            p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+            calls = row["calls"]
+            lines.append(
+                f"{feature} / {model}: {calls}回 (エラー {row['errors']}) "
+                f"入力 {row['prompt_tokens']} (平均 {row['prompt_tokens'] // calls} / 最大 {row['max_prompt']}) "
+                f"出力 {row['response_tokens']} 時間 p50 {p50:.2f}s / p95 {p95:.2f}s"
+            )
+        return lines
+
+
+_pool = None
+_usage = None
+_models = {}
+_models_lock = threading.Lock()
+
+def get_pool():
+    # Cog間で共有する（全体の同時実行数の上限を1か所で管理するため）
+    global _pool
+    if _pool is None:
+        _pool = LLMPool()
+        registry.register_collector("llm", collect_pool_metrics)
+    return _pool
+
+def collect_pool_metrics():
+    registry.gauge("llm_in_flight", "LLM calls currently running").set(_pool.active)
+    registry.gauge("llm_waiting", "LLM calls waiting for a free slot").set(_pool.limiter.waiting())
+
+def get_usage():
+    global _usage
+    if _usage is None:
+        _usage = UsageStats()
+    return _usage
+
+def get_model(name, system_instruction=None):
+    # SDKの読み込みとクライアント作成は、最初に使われる時まで遅らせる（起動を軽くするため）
+    # ワーカースレッドから呼ばれるので、作成はロックで1回だけにする
+    # システムプロンプトごとにモデルを作り置きして、毎回同じ先頭部分を送る
+    with _models_lock:
+        model = _models.get((name, system_instruction))
+        if model is None:
+            import google.generativeai as genai
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+            model = _models[(name, system_instruction)] = genai.GenerativeModel(name, system_instruction=system_instruction)
+        return model
+
+def llm_health():
+    # LLMが使えそうか（キーがあるか・混み具合・直近のエラー率）
+    pool, usage, router = get_pool(), get_usage(), get_router()
+    errors = usage.recent.count(False)
+    error_rate = errors / len(usage.recent) if usage.recent else 0.0
+    has_key = LLM_PROVIDER == "local" or bool(os.getenv("GEMINI_API_KEY"))
+    models = router.describe()
+    return {
+        "api_key": has_key,
+        "in_flight": pool.active,
+        "waiting": pool.limiter.waiting(),
+        "capacity": pool.concurrency,
+        "recent_error_rate": round(error_rate, 2),
+        "models": models,
+        "healthy": has_key and any(not m["open"] for m in models.values()) and (len(usage.recent) < 5 or error_rate < 0.5),
+    }
+
+def estimate_tokens(text):
+    # ざっくり見積もり: 日本語は1文字≒1トークン、英数字は4文字≒1トークン
+    ascii_chars = sum(1 for c in text if c < "\x80")
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def count_tokens(contents):
+    # 文字列 / [{"role": ..., "parts": [...]}] のどちらでも見積もる
+    if isinstance(contents, str): return estimate_tokens(contents)
+    return sum(estimate_tokens(part) for c in contents for part in c["parts"])
+
+def usage_tokens(response, prompt_estimate, text):
+    # APIが返した実際のトークン数があればそちらを使う（無ければ見積もり）
+    meta = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(meta, "prompt_token_count", 0) or prompt_estimate
+    response_tokens = getattr(meta, "candidates_token_count", 0) or estimate_tokens(text)
+    return prompt_tokens, response_tokens
+
+def fit_history(head, history, tail, budget):
+    # head（キャラ設定など）と tail（今回の発言）は必ず残して、
+    # 上限を超える分は履歴の古いやり取りから2件（質問と返事）ずつ削る
+    fixed = count_tokens(head) + count_tokens(tail)
+    costs = [count_tokens([c]) for c in history]
+    total = fixed + sum(costs)
+    start = 0
+    while total > budget and start < len(history):
+        total -= sum(costs[start:start + 2])
+        start += 2
+    return head + history[start:] + tail
+
+
+# ------------------------------------------------------------------
+# プロバイダー層（どのモデルに投げるかをここで決める）
+# 機能（chat / search）ごとに候補のモデルを優先順に並べておき、
+#   - プロンプトが入りきらないモデルは使わない
+#   - 最近エラーが多い / 回路遮断中のモデルは後回し
+#   - 大きいプロンプトは、最近速いモデルを優先
+# の順で選ぶ。失敗したら次の候補へ（同じモデルをもう一度なら少し待ってから）。
+# 連続で失敗したモデルはしばらく使わない（回路遮断）。時間が経ったら1回だけ試す。
+# LLM_PROVIDER=local にすると、全部ローカルの代役で答える（APIキー無しでの動作確認用）。
+# ------------------------------------------------------------------
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))   # 同じモデルをやり直す時の待ち時間(秒)。回数ごとに倍
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "4"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))   # 連続で何回失敗したら遮断するか
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30")) # 遮断する秒数
+LLM_ERROR_THRESHOLD = 0.5   # 最近のエラー率がこれを超えたら後回し
+LLM_ERROR_HALFLIFE = 60.0   # エラー率は何もなくてもこの秒数で半分に戻る（後回しのモデルにもいずれ戻る）
+LLM_LARGE_PROMPT = int(os.getenv("LLM_LARGE_PROMPT", "4000")) # これより大きいプロンプトは速さ優先
+EWMA_ALPHA = 0.3
+
+# モデルごとの性質（max_prompt: 入力の上限トークン / system: system_instruction を使えるか）
+MODELS = {
+    "gemini-pro": {"provider": "gemini", "max_prompt": 30000, "system": False},
+    "gemini-1.5-flash": {"provider": "gemini", "max_prompt": 1000000, "system": True},
+}
+ROUTES = {
+    "chat": os.getenv("LLM_ROUTE_CHAT", "gemini-pro,gemini-1.5-flash").split(","),
+    "search": os.getenv("LLM_ROUTE_SEARCH", "gemini-1.5-flash,gemini-pro").split(","),
+}
+PROVIDERS = ("gemini", "local")
+
+def check_config():
+    # 設定ミスは起動時に警告して既定値に戻す（呼び出すたびに KeyError にならないように）
+    global LLM_PROVIDER, LLM_MAX_ATTEMPTS
+    if LLM_PROVIDER not in PROVIDERS:
+        print(f"⚠️ LLM: LLM_PROVIDER={LLM_PROVIDER!r} は使えません（{' / '.join(PROVIDERS)}）。gemini を使います")
+        LLM_PROVIDER = "gemini"
+    if LLM_MAX_ATTEMPTS < 1:
+        print(f"⚠️ LLM: LLM_MAX_ATTEMPTS={LLM_MAX_ATTEMPTS} は1以上にしてください。1 を使います")
+        LLM_MAX_ATTEMPTS = 1
+    for task, names in ROUTES.items():
+        unknown = [m for m in names if m not in MODELS]
+        if unknown:
+            print(f"⚠️ LLM: {task} の候補に知らないモデルがあるので外します: {', '.join(unknown)}")
+        ROUTES[task] = [m for m in names if m in MODELS] or list(MODELS)
+
+check_config()
+
+
+class LLMReply:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class GeminiProvider:
+    def generate(self, model, contents, system_instruction=None, stream=False):
+        # ワーカースレッドで呼ばれる
+        return get_model(model, system_instruction).generate_content(contents, stream=stream)
+
+
+class LocalProvider:
+    # APIを使わない代役（テスト・オフライン確認用）。最後の発言をそのまま返す
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def generate(self, model, contents, system_instruction=None, stream=False):
+        last = contents if isinstance(contents, str) else contents[-1]["parts"][0]
+        text = f"（ローカル応答）{last[-200:]}"
+        if not stream:
+            time.sleep(self.latency)
+            return LLMReply(text)
+        return self.stream(text)
+
+    def stream(self, text):
+        for i in range(0, len(text), 40):
+            time.sleep(self.latency / max(1, len(text) // 40))
+            yield LLMReply(text[i:i + 40])
+
+
+class ModelHealth:
+    def __init__(self):
+        self.latency = None   # 1回あたりの秒数（指数移動平均）
+        self.errors = 0.0     # エラー率（指数移動平均。時間でも減る）
+        self.updated = time.monotonic()
+        self.failures = 0     # 連続失敗回数
+        self.open_until = 0.0 # この時刻まで遮断
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def error_rate(self):
+        return self.errors * 0.5 ** ((time.monotonic() - self.updated) / LLM_ERROR_HALFLIFE)
+
+    def observe(self, failed):
+        self.errors = self.error_rate() + EWMA_ALPHA * (failed - self.error_rate())
+        self.updated = time.monotonic()
+
+    def success(self, seconds):
+        self.latency = seconds if self.latency is None else self.latency + EWMA_ALPHA * (seconds - self.latency)
+        self.observe(0.0)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def failure(self):
+        self.observe(1.0)
+        self.failures += 1
+        if self.failures >= LLM_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+
+
+class LLMRouter:
+    def __init__(self, pool, usage):
+        self.pool = pool
+        self.usage = usage
+        self.providers = {"gemini": GeminiProvider(), "local": LocalProvider()}
+        self.health = {name: ModelHealth() for name in MODELS}
+
+    def provider_for(self, model):
+        return self.providers[LLM_PROVIDER if LLM_PROVIDER != "gemini" else MODELS[model]["provider"]]
+
+    def candidates(self, task, prompt_tokens):
+        names = [m for m in ROUTES[task] if prompt_tokens <= MODELS[m]["max_prompt"]]
+        if not names: names = [max(ROUTES[task], key=lambda m: MODELS[m]["max_prompt"])]
+        large = prompt_tokens > LLM_LARGE_PROMPT
+        def rank(item):
+            i, name = item
+            h = self.health[name]
+            slow = h.latency if (large and h.latency is not None) else 0.0
+            return (h.is_open(), h.error_rate() > LLM_ERROR_THRESHOLD, slow, i)
+        return [name for _, name in sorted(enumerate(names), key=rank)]
+
+    def plan(self, task, prompt_tokens):
+        # 試す順番（候補を順に回す。全部遮断中でも1回は試す）
+        names = self.candidates(task, prompt_tokens)
+        healthy = [m for m in names if not self.health[m].is_open()] or names[:1]
+        plan = [healthy[i % len(healthy)] for i in range(LLM_MAX_ATTEMPTS)]
+        if not plan:
+            # 黙って None を返すと呼び出し側で分かりにくい壊れ方をするので、ここで止める
+            raise RuntimeError(f"LLM: {task} で試せるモデルがありません")
+        return plan
+
+    def prepare(self, model, contents, system_instruction):
+        # system_instruction が使えないモデルには、最初のやり取りとして渡す
+        if system_instruction is None or MODELS[model]["system"]:
+            return contents, system_instruction
+        if isinstance(contents, str):
+            return f"{system_instruction}\n\n{contents}", None
+        preamble = [
+            {"role": "user", "parts": [system_instruction]},
+            {"role": "model", "parts": ["わかりました。"]},
+        ]
+        return preamble + contents, None
+
+    async def backoff(self, plan, attempt):
+        # 同じモデルをもう一度試す時だけ待つ（別のモデルに切り替える時はすぐ）
+        if attempt + 1 < len(plan) and plan[attempt + 1] == plan[attempt]:
+            delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    def finish(self, task, model, started, prompt_tokens, response, text, ok):
+        # ok=None は呼び出し側の都合で途中で止めた場合（キャンセル・ストリームを閉じた）
+        # モデルのせいではないので、使った分だけ記録して成功・失敗には数えない
+        seconds = time.perf_counter() - started
+        if ok: self.health[model].success(seconds)
+        elif ok is not None: self.health[model].failure()
+        used_prompt, used_response = usage_tokens(response, prompt_tokens, text)
+        self.usage.record(task, model, used_prompt, used_response, seconds, ok is not False)
+
+    async def generate(self, task, contents, system_instruction=None, user_id=None):
+        # 1回で返す呼び出し。返り値は (応答, 使ったモデル名)
+        # user_id は混んでいる時の順番待ちを人ごとに公平にするため
+        prompt_tokens = count_tokens(contents) + (estimate_tokens(system_instruction) if system_instruction else 0)
+        plan = self.plan(task, prompt_tokens)
+        for attempt, model in enumerate(plan):
+            payload, system = self.prepare(model, contents, system_instruction)
+            started = time.perf_counter()
+            response, text, ok = None, "", None
+            try:
+                response = await self.pool.run(user_id, self.provider_for(model).generate, model, payload, system)
+                text = response.text
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"⚠️ LLM Error ({task} / {model}, {attempt + 1}/{len(plan)}回目): {e!r}")
+                if attempt + 1 == len(plan): raise
+            finally:
+                self.finish(task, model, started, prompt_tokens, response if ok else None, text, ok)
+            if ok: return response, model
+            await self.backoff(plan, attempt)
+
+    async def stream(self, task, contents, system_instruction=None, user_id=None):
+        # ストリーミング。最初のチャンクが届く前に失敗した時だけ別のモデルでやり直す
+        # （途中まで表示してから切り替えると、返事が混ざってしまうため）
+        prompt_tokens = count_tokens(contents) + (estimate_tokens(system_instruction) if system_instruction else 0)
+        plan = self.plan(task, prompt_tokens)
+        for attempt, model in enumerate(plan):
+            payload, system = self.prepare(model, contents, system_instruction)
+            started = time.perf_counter()
+            parts, last, ok = [], None, None
+            try:
+                async with aclosing(self.pool.stream(user_id, self.provider_for(model).generate, model, payload, system, stream=True)) as chunks:
+                    async for chunk in chunks:
+                        last = chunk
+                        parts.append(chunk.text)
+                        yield chunk
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"⚠️ LLM Error ({task} / {model}, {attempt + 1}/{len(plan)}回目): {e!r}")
+                if parts or attempt + 1 == len(plan): raise
+            finally:
+                # 呼び出し側が途中で閉じた時（GeneratorExit）もここは通る
+                self.finish(task, model, started, prompt_tokens, last, "".join(parts), ok)
+            if ok: return
+            await self.backoff(plan, attempt)
+
+    def describe(self):
+        return {
+            name: {
+                "latency": round(h.latency, 2) if h.latency is not None else None,
+                "error_rate": round(h.error_rate(), 2),
+                "open": h.is_open(),
+            }
+            for name, h in self.health.items()
+        }
+
+
+_router = None
+
+def get_router():
+    global _router
+    if _router is None:
+        _router = LLMRouter(get_pool(), get_usage())
+    return _router
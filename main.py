@@ -1,48 +1,129 @@
-import discord
+import time
+PROCESS_START = time.perf_counter() # 起動時間の計測開始（一番最初に記録する）
+
+from discord import PrivilegedIntentsRequired
 from discord.ext import commands
 import os
+import sys
 import asyncio
 from dotenv import load_dotenv
+from command_sync import auto_sync, sync_commands
+from hot_reload import extension_name, reload_with_state
+from llm import get_usage
+from metrics import registry, TimedCommandTree, gateway_collector
+from keep_alive import HealthServer
+from outbound import get_outbound
+from quota import get_quotas
+from startup import STARTUP_SECONDS, DISABLED_EXTENSIONS, optional_privileged, discover_extensions, collect_profiles, build_bot_options, describe_options, report_footprint, load_extensions, print_timing_table
 
 # .envファイルを読み込む
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-# Botの設定
-intents = discord.Intents.default()
-intents.message_content = True 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# main.py 自身に必要な設定（!sync のプレフィックスコマンド）
+PROFILE = {"intents": ["guilds", "guild_messages", "message_content"]}
+
+# Botの設定（各Cogの PROFILE から必要最小限の intents / キャッシュを決める）
+EXTENSIONS = discover_extensions()
+startup_timings = {}
+profiles = collect_profiles(EXTENSIONS)
+profiles["main"] = PROFILE
+bot_options = build_bot_options(profiles)
+bot = commands.Bot(command_prefix="!", tree_cls=TimedCommandTree, **bot_options)
+
+# 起動から on_ready までの秒数（再接続で on_ready が何度来ても最初の1回だけ記録）
+bot.startup_seconds = None
+# !reload の時に Cog が状態を受け渡す場所 {Cog名: 状態}
+bot.cog_snapshots = {}
 
 # 起動時の処理
 @bot.event
 async def on_ready():
+    if bot.startup_seconds is None:
+        bot.startup_seconds = time.perf_counter() - PROCESS_START
+        STARTUP_SECONDS.set(bot.startup_seconds)
     print(f"🚀 新型Bot (ota_bot2) 起動: {bot.user}")
+    print(f"⏱️ 起動から on_ready まで: {bot.startup_seconds:.2f}秒")
+    describe_options(bot_options)
+    report_footprint(bot)
     print("------")
 
-# Cogs読み込み
-async def load_extensions():
-    for filename in os.listdir('./cogs'):
-        if filename.endswith('.py'):
-            try:
-                await bot.load_extension(f'cogs.{filename[:-3]}')
-                print(f"✅ Loaded: {filename}")
-            except Exception as e:
-                print(f"⚠️ Failed to load {filename}: {e}")
-
-# 同期コマンド (!sync)
+# ログイン直後（接続前）にコマンド定義が変わっていれば自動で同期し、計測を始める
+async def setup_hook():
+    await auto_sync(bot)
+    # 計測（イベントループの遅れ・Gatewayの遅延など）を開始
+    registry.register_collector("gateway", gateway_collector(bot))
+    registry.start()
+bot.setup_hook = setup_hook
+
+# 同期コマンド (!sync) ... 変更が無くても強制的に同期する
 @bot.command()
 async def sync(ctx):
     print("同期を開始します...")
     await ctx.message.delete()
-    synced = await bot.tree.sync()
-    msg = await ctx.send(f"✅ {len(synced)} 個のコマンドを同期しました！")
+    count = await sync_commands(bot, force=True)
+    msg = await ctx.send(f"✅ {count} 個のコマンドを同期しました！")
     await asyncio.sleep(5)
     await msg.delete()
 
+# Cogの入れ替え (!reload chat) ... 再起動せずに、状態を引き継いだまま新しいコードにする
+@bot.command()
+@commands.is_owner()
+async def reload(ctx, name: str):
+    await ctx.message.delete()
+    name = extension_name(name)
+    try:
+        seconds = await reload_with_state(bot, name)
+    except commands.ExtensionError as e:
+        print(f"❌ Reload Error ({name}): {e}")
+        msg = await ctx.send(f"❌ {name} の再読み込みに失敗しました: {e}")
+    else:
+        print(f"♻️ Reloaded: {name} ({seconds * 1000:.1f}ms)")
+        msg = await ctx.send(f"♻️ {name} を再読み込みしました！ ({seconds * 1000:.1f}ms)")
+        # intents などは接続時に決まるので、PROFILE が変わった場合は再起動が必要
+        if getattr(sys.modules.get(name), "PROFILE", {}) != profiles.get(name, {}):
+            print(f"⚠️ {name} の PROFILE が変わっています。反映するには再起動してください")
+        # コマンド定義が変わっていれば同期する
+        await auto_sync(bot)
+    await asyncio.sleep(5)
+    await msg.delete()
+
+# LLMの使用量 (!llmstats) ... 機能・モデルごとのトークン数と所要時間
+@bot.command()
+@commands.is_owner()
+async def llmstats(ctx):
+    usage = get_usage()
+    lines = usage.summary() or ["まだ呼び出しはありません"]
+    hours = (time.time() - usage.started) / 3600
+    await ctx.send(f"📊 **LLM使用量** (直近 {hours:.1f}時間)\n```\n" + "\n".join(lines) + "\n```")
+
 async def main():
+    restart_without = []
     async with bot:
-        await load_extensions()
-        await bot.start(TOKEN)
+        # Cogs読み込み
+        loaded = await load_extensions(bot, EXTENSIONS, startup_timings)
+        print(f"✅ Loaded: {', '.join(loaded)}")
+        print_timing_table(EXTENSIONS, startup_timings)
+        # 死活監視サーバー（Botと同じループで動かして、止める時は一緒に閉じる）
+        health = HealthServer(bot, EXTENSIONS)
+        await health.start()
+        try:
+            await bot.start(TOKEN)
+        except PrivilegedIntentsRequired:
+            # Developer Portal で特権intentが有効になっていない。無くてもよいCogを外して起動し直す
+            restart_without = optional_privileged(profiles)
+            if not restart_without: raise
+            print(f"⚠️ 特権intentが有効になっていません（Developer Portal の Bot 設定を確認してください）。{', '.join(restart_without)} を外して起動し直します")
+        finally:
+            # 送信待ちのお知らせを送り切ってから止める
+            await get_outbound().close()
+            get_quotas().close()
+            registry.stop()
+            await health.stop()
+    if restart_without:
+        # intents は Bot を作った時に決まるので、プロセスごと起動し直す
+        os.environ["DISABLED_EXTENSIONS"] = ",".join(DISABLED_EXTENSIONS + restart_without)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
 
 if __name__ == '__main__':
     if TOKEN:
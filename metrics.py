@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+import math
+import os
+import time
+from contextlib import contextmanager
+from discord import app_commands, ui
+
+# ------------------------------------------------------------------
+# 計測値の集計（Prometheus のテキスト形式で /metrics から出す）
+# 記録はイベントループ上で dict を足し算するだけなので、どこから呼んでも軽い。
+# 今の値を読むだけのもの（キューの長さ・パネル数など）は collector として登録しておくと、
+# サンプラーがイベントループ上で定期的に読みに行く（/metrics は集計済みの値を出すだけ）。
+# ------------------------------------------------------------------
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "1.0")) # イベントループの遅れを測る間隔(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series = {} # {ラベル: [各バケットの件数..., 合計, 件数]}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        # 累積は出力する時に計算する（記録は該当バケット1つだけ）
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets): series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in list(self.series.items()):
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, kind="counter"):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.series = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in list(self.series.items()):
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, kind="gauge")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {} # {名前: 同期関数}（サンプラーがイベントループ上で呼ぶ）
+        self.task = None
+
+    def add(self, metric):
+        # 同じ名前は使い回す（!reload で Cog が作り直されても値を引き継ぐ）
+        return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def register_collector(self, name, func):
+        self.collectors[name] = func
+
+    def unregister_collector(self, name):
+        self.collectors.pop(name, None)
+
+    def collect(self):
+        for name, func in list(self.collectors.items()):
+            try:
+                func()
+            except Exception as e:
+                print(f"⚠️ Metrics: {name} の集計に失敗しました: {e}")
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.sample_loop())
+
+    async def sample_loop(self):
+        # 決めた時間だけ眠って、実際に何秒遅れて起きたか = 他の処理がループを止めていた時間
+        lag = self.histogram("event_loop_lag_seconds", "How late the event loop woke up from a timed sleep", LAG_BUCKETS)
+        lag_max = self.gauge("event_loop_lag_max_seconds", "Worst event loop lag in the last 60 seconds")
+        worst, window_started = 0.0, time.monotonic()
+        while True:
+            expected = time.monotonic() + METRICS_INTERVAL
+            await asyncio.sleep(METRICS_INTERVAL)
+            delay = max(0.0, time.monotonic() - expected)
+            lag.observe(delay)
+            worst = max(worst, delay)
+            lag_max.set(worst)
+            if time.monotonic() - window_started >= 60:
+                worst, window_started = 0.0, time.monotonic()
+            self.collect()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+registry = Registry()
+
+COMMAND_SECONDS = registry.histogram("discord_command_seconds", "Slash command handling time")
+COMPONENT_SECONDS = registry.histogram("discord_component_seconds", "Button/modal callback handling time")
+LLM_SECONDS = registry.histogram("llm_call_seconds", "LLM call duration")
+LLM_TOKENS = registry.counter("llm_tokens_total", "LLM tokens sent and received")
+SEARCH_SECONDS = registry.histogram("search_stage_seconds", "Web search pipeline stage duration")
+COMMAND_ERRORS = registry.counter("discord_command_errors_total", "Slash commands that raised an error")
+
+@contextmanager
+def timed(histogram, **labels):
+    # with timed(COMPONENT_SECONDS, action="join"): ... 失敗した時も status="error" で記録する
+    started = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        histogram.observe(time.perf_counter() - started, status=status, **labels)
+
+
+class TimedCommandTree(app_commands.CommandTree):
+    # スラッシュコマンドの処理時間を全部ここで測る（discord.py の公開されているフックだけを使う）
+    #   interaction_check             ... 実行前に必ず呼ばれるので、ここで開始時刻を控える
+    #   on_app_command_completion     ... 成功して終わった時（Bot のイベント）
+    #   on_error                      ... 失敗した時
+    # オートコンプリートには終わった時のフックが無いので、各Cogで timed(..., kind="autocomplete") を使う
+    def __init__(self, client, *args, **kwargs):
+        super().__init__(client, *args, **kwargs)
+        client.add_listener(self.on_app_command_completion)
+
+    async def interaction_check(self, interaction):
+        interaction.extras["metrics_started"] = time.perf_counter()
+        return True
+
+    def observe(self, interaction, status):
+        started = interaction.extras.pop("metrics_started", None)
+        if started is None: return
+        name = (interaction.data or {}).get("name", "?")
+        COMMAND_SECONDS.observe(time.perf_counter() - started, status=status, command=name, kind="command")
+
+    async def on_app_command_completion(self, interaction, command):
+        self.observe(interaction, "ok")
+
+    async def on_error(self, interaction, error):
+        name = (interaction.data or {}).get("name", "?")
+        COMMAND_ERRORS.inc(command=name)
+        self.observe(interaction, "error")
+        await super().on_error(interaction, error)
+
+
+class TimedView(ui.View):
+    # ボタン・セレクトの処理時間を COMPONENT_SECONDS に記録する View
+    # 各アイテムのコールバックを包むので、コールバックは add_item より前に設定しておくこと
+    component = "view"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for item in self.children: self.wrap(item) # @discord.ui.button などで書いたもの
+
+    def add_item(self, item):
+        self.wrap(item)
+        return super().add_item(item)
+
+    def wrap(self, item):
+        callback = item.callback
+        if getattr(callback, "timed", False): return
+        # ラベルはコールバックの関数名（custom_id は毎回変わるので使わない）
+        action = getattr(callback, "__name__", None) or getattr(getattr(callback, "callback", None), "__name__", type(item).__name__)
+        async def timed_callback(interaction):
+            with timed(COMPONENT_SECONDS, component=self.component, action=action):
+                await callback(interaction)
+        timed_callback.timed = True
+        item.callback = timed_callback
+
+
+def gateway_collector(bot):
+    gauge = registry.gauge("discord_gateway_latency_seconds", "Heartbeat latency to the Discord gateway")
+    def collect():
+        # 接続前は inf / nan になるので出さない
+        if math.isfinite(bot.latency): gauge.set(bot.latency)
+    return collect
@@ -0,0 +1,79 @@
+import unicodedata
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+# ------------------------------------------------------------------
+# オートコンプリート用の名前インデックス
+# 全角/半角・大文字/小文字・ひらがな/カタカナの違いを無視して検索する。
+# 前方一致を先に、部分一致をその後に返す。
+# ------------------------------------------------------------------
+HIRA_START, HIRA_END = 0x3041, 0x3096
+KATA_OFFSET = 0x60
+
+def fold(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    # ひらがな → カタカナ
+    return "".join(chr(ord(c) + KATA_OFFSET) if HIRA_START <= ord(c) <= HIRA_END else c for c in text)
+
+def gram_positions(text):
+    # {1文字/2文字: 最初に出てくる位置}（1文字の入力でも部分一致を引けるように1文字も入れる）
+    positions = {}
+    for i, c in enumerate(text):
+        positions.setdefault(c, i)
+        if i + 1 < len(text): positions.setdefault(text[i:i + 2], i)
+    return positions
+
+
+class NameIndex:
+    def __init__(self, names=()):
+        self.folded = {}               # {名前: 正規化した名前}
+        self.ordered = []              # [(正規化した名前, 名前)] 前方一致用にソート済み
+        self.grams = defaultdict(list) # {文字/2文字: [(位置, 正規化した名前, 名前)]} 部分一致用。前に出てくる順
+        for name in names: self.add(name)
+
+    def __len__(self):
+        return len(self.folded)
+
+    def add(self, name):
+        if name in self.folded: return
+        key = fold(name)
+        self.folded[name] = key
+        insort(self.ordered, (key, name))
+        for g, pos in gram_positions(key).items(): insort(self.grams[g], (pos, key, name))
+
+    def remove(self, name):
+        key = self.folded.pop(name, None)
+        if key is None: return
+        i = bisect_left(self.ordered, (key, name))
+        del self.ordered[i]
+        for g, pos in gram_positions(key).items():
+            entries = self.grams[g]
+            del entries[bisect_left(entries, (pos, key, name))]
+            if not entries: del self.grams[g]
+
+    def search(self, query, limit=25):
+        q = fold(query)
+        if not q:
+            return [name for _, name in self.ordered[:limit]]
+
+        # 1. 前方一致（ソート済みなので二分探索で先頭を見つけて順に読むだけ）
+        hits = []
+        i = bisect_left(self.ordered, (q,))
+        while i < len(self.ordered) and len(hits) < limit:
+            key, name = self.ordered[i]
+            if not key.startswith(q): break
+            hits.append(name)
+            i += 1
+        if len(hits) >= limit: return hits
+
+        # 2. 部分一致
+        # 一番件数の少ない n-gram のリストを「前の方で出てくる順」に見ていき、本当に含むものだけ拾う
+        keys = {q} if len(q) == 1 else {q[j:j + 2] for j in range(len(q) - 1)}
+        lists = [self.grams.get(g) for g in keys]
+        if not all(lists): return hits
+        prefix_hits = set(hits)
+        for _, key, name in min(lists, key=len):
+            if name in prefix_hits or q not in key: continue
+            hits.append(name)
+            if len(hits) >= limit: break
+        return hits
@@ -0,0 +1,162 @@
+import asyncio
+import itertools
+from collections import deque
+import os
+import time
+import traceback
+from metrics import registry
+
+# ------------------------------------------------------------------
+# 送信キュー（お知らせ・通知をまとめて送る係）
+# - チャンネルごとに「5秒で5通」のバケツを持って、レート制限に当たる前に自分で待つ
+# - チャンネルごとに列（先に積んだ順）を作り、優先度つきの待ち行列には各列の先頭だけを入れる
+#   → 同じチャンネル宛ては必ず積んだ順に1通ずつ、別のチャンネル宛ては並行して送る
+# - 優先度の高いもの（満員通知など）が先頭にいるチャンネルから送る。募集のお知らせなどは後回しでよい
+# - 同じ dedupe キーの送信が待ち行列にあれば、新しい方は捨てて同じ結果を返す
+# インタラクションへの返事はここを通さずにすぐ返して、残りをここに積む。
+# ------------------------------------------------------------------
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+ROUTE_BURST = int(os.getenv("OUTBOUND_ROUTE_BURST", "5"))    # チャンネルごとに続けて送れる数
+ROUTE_WINDOW = float(os.getenv("OUTBOUND_ROUTE_WINDOW", "5")) # その数が回復するまでの秒数
+GLOBAL_PER_SECOND = int(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", "40")) # Bot全体（Discordの上限50/秒より少し下）
+
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+QUEUE_WAIT = registry.histogram("outbound_queue_wait_seconds", "Time an outbound message waited before being sent")
+SENT = registry.counter("outbound_messages_total", "Outbound messages by result")
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_seconds):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self):
+        # 取れたら0、取れなければ何秒待てばよいかを返す
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class Outbound:
+    def __init__(self, workers=OUTBOUND_WORKERS):
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.routes = {}    # {チャンネルID: TokenBucket}
+        self.lanes = {}     # {チャンネルID: deque[job]}  まだ送っていないもの（積んだ順）
+        self.pending = {}   # {dedupe キー: Future}
+        self.unsent = 0     # まだ送り終わっていない数（待ち行列・待機中・送信中の合計）
+        self.global_bucket = TokenBucket(GLOBAL_PER_SECOND, 1)
+        self.counter = itertools.count()
+
+    def start(self):
+        if self.tasks: return
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        registry.register_collector("outbound", self.collect_metrics)
+
+    def send(self, channel, content=None, priority=NORMAL, dedupe=None, **kwargs):
+        # 待たずに Future を返す（結果が要る時だけ await する）
+        if dedupe is not None and dedupe in self.pending:
+            return self.pending[dedupe]
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        # 誰も結果を見なくても「例外が取り出されなかった」警告を出さない（ログは worker で出す）
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.unsent += 1
+        future.add_done_callback(self.sent)
+        if dedupe is not None:
+            self.pending[dedupe] = future
+            future.add_done_callback(lambda f: self.pending.pop(dedupe, None))
+        job = (priority, next(self.counter), channel, content, kwargs, future, time.monotonic())
+        route = channel.id
+        lane = self.lanes.get(route)
+        if lane is None:
+            # 列が無い = 待ち行列にこのチャンネルの分が入っていないので、先頭として入れる
+            self.lanes[route] = deque([job])
+            self.schedule(route)
+        else:
+            lane.append(job)
+        return future
+
+    def sent(self, future):
+        self.unsent -= 1
+
+    def schedule(self, route):
+        # 列の先頭を待ち行列に入れる（各チャンネルにつき常に1つだけ）
+        lane = self.lanes[route]
+        while lane and lane[0][5].done(): lane.popleft() # 取り消されたものは送らない
+        if not lane:
+            del self.lanes[route]
+            return
+        priority, seq = lane[0][:2]
+        self.queue.put_nowait((priority, seq, route))
+
+    async def worker(self):
+        while True:
+            _, _, route = await self.queue.get()
+            lane = self.lanes.get(route)
+            if not lane: continue
+            bucket = self.routes.get(route)
+            if bucket is None:
+                bucket = self.routes[route] = TokenBucket(ROUTE_BURST, ROUTE_WINDOW)
+            # チャンネル側が空くまでは列ごと後回し（その間は全体の枠を使わない）
+            wait = bucket.take()
+            if wait:
+                asyncio.get_running_loop().call_later(wait, self.schedule, route)
+                continue
+            # 全体の枠は最大でも 1/GLOBAL_PER_SECOND 秒待てば空くので、ここで待つ
+            while wait := self.global_bucket.take():
+                await asyncio.sleep(wait)
+
+            priority, _, channel, content, kwargs, future, queued_at = lane.popleft()
+            try:
+                if not future.done():
+                    QUEUE_WAIT.observe(time.monotonic() - queued_at, priority=PRIORITY_NAMES[priority])
+                    message = await channel.send(content, **kwargs)
+                    future.set_result(message)
+                    SENT.inc(result="ok")
+            except Exception as e:
+                print(f"❌ Outbound Error (channel {route}): {e}")
+                traceback.print_exc()
+                if not future.done(): future.set_exception(e)
+                SENT.inc(result="error")
+            finally:
+                # 送り終わってから次を入れる（同じチャンネルは1通ずつ、順番どおり）
+                self.schedule(route)
+                # 使っていないチャンネルのバケツは捨てる（満タンなら作り直しても同じ）
+                if len(self.routes) > 256:
+                    for key in [k for k, b in self.routes.items() if k not in self.lanes and b.idle()]:
+                        del self.routes[key]
+
+    def collect_metrics(self):
+        registry.gauge("outbound_queue_depth", "Outbound messages waiting to be sent").set(self.unsent)
+
+    async def close(self, timeout=5):
+        # 止める前に、待っている分をできるだけ送り切る
+        deadline = time.monotonic() + timeout
+        while self.unsent and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self.tasks: task.cancel()
+        self.tasks = []
+        registry.unregister_collector("outbound")
+
+
+_outbound = None
+
+def get_outbound():
+    global _outbound
+    if _outbound is None:
+        _outbound = Outbound()
+    return _outbound
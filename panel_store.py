@@ -0,0 +1,56 @@
+import json
+import os
+import sqlite3
+import time
+
+# ------------------------------------------------------------------
+# 募集パネルの状態をSQLiteに保存する
+# 再起動してもボタンが使えるように、クリックされた時にここから読み直す
+# ------------------------------------------------------------------
+PANEL_DB = "data/panels.db"
+
+class PanelStore:
+    def __init__(self, path=PANEL_DB):
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS panels ("
+            "panel_id INTEGER PRIMARY KEY, channel_id INTEGER, message_id INTEGER, state TEXT, updated_at REAL)"
+        )
+        self.db.commit()
+        # 件数はメモリで数えておく（メトリクスのたびに COUNT(*) しない）
+        self.size = self.db.execute("SELECT COUNT(*) FROM panels").fetchone()[0]
+
+    def load(self, panel_id):
+        row = self.db.execute("SELECT state, channel_id, message_id FROM panels WHERE panel_id = ?", (panel_id,)).fetchone()
+        if row is None: return None
+        state = json.loads(row[0])
+        state["channel_id"], state["message_id"] = row[1], row[2]
+        return state
+
+    def save(self, panel_id, state, channel_id=None, message_id=None):
+        # ほとんどは既存パネルの更新なので UPDATE を先に。無かった時だけ新しく入れる
+        text = json.dumps(state, ensure_ascii=False)
+        cur = self.db.execute(
+            "UPDATE panels SET state = ?, updated_at = ?, "
+            "channel_id = COALESCE(?, channel_id), message_id = COALESCE(?, message_id) WHERE panel_id = ?",
+            (text, time.time(), channel_id, message_id, panel_id)
+        )
+        if cur.rowcount == 0:
+            self.db.execute(
+                "INSERT INTO panels (panel_id, channel_id, message_id, state, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (panel_id, channel_id, message_id, text, time.time())
+            )
+            self.size += 1
+        self.db.commit()
+
+    def count(self):
+        return self.size
+
+    def delete(self, panel_id):
+        cur = self.db.execute("DELETE FROM panels WHERE panel_id = ?", (panel_id,))
+        self.db.commit()
+        self.size -= cur.rowcount
+
+    def close(self):
+        self.db.close()
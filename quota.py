@@ -0,0 +1,213 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from metrics import registry
+
+# ------------------------------------------------------------------
+# 使いすぎ防止（/chat と /search の回数制限）
+# コマンドごとに「1人あたり」「1サーバーあたり」のバケツを持つ。
+# 例: QUOTA_CHAT_USER=5/60 なら、1人5回まで続けて使えて、60秒で5回分回復する。
+# 制限にかかった時は「あとN秒」を返すので、コマンド側で本人にだけ知らせる。
+# QUOTA_PERSIST=1 にすると、残り回数を data/quota.json に保存して再起動後も引き継ぐ。
+#
+# LLMの同時実行数がいっぱいの時の順番待ちは FairLimiter で、人ごとに順番に回す
+# （1人がたくさん投げても、他の人が後ろでずっと待たされないように）。
+# ------------------------------------------------------------------
+QUOTA_FILE = "data/quota.json"
+QUOTA_PERSIST = os.getenv("QUOTA_PERSIST", "0") == "1"
+QUOTA_SAVE_INTERVAL = 60
+QUOTA_MAX_BUCKETS = 2000 # これを超えたら一番長く使っていないバケツから捨てる
+
+def parse_rate(text):
+    # "5/60" → (5回, 60秒)。"0" や空なら制限なし。おかしな値は ValueError
+    if not text or text == "0": return None
+    count, seconds = text.split("/")
+    count, seconds = int(count), float(seconds)
+    if count < 1 or seconds <= 0: raise ValueError("回数は1以上、秒数は0より大きくしてください")
+    return count, seconds
+
+def rate_from_env(name, default):
+    # 設定ミスで起動できなくならないように、読めない値は警告して既定値を使う
+    text = os.getenv(name, default)
+    try:
+        return parse_rate(text)
+    except ValueError as e:
+        print(f"⚠️ Quota: {name}={text!r} は「回数/秒数」（例: 5/60）として読めません。{default} を使います: {e}")
+        return parse_rate(default)
+
+QUOTAS = {
+    "chat": {
+        "user": rate_from_env("QUOTA_CHAT_USER", "6/60"),
+        "guild": rate_from_env("QUOTA_CHAT_GUILD", "40/60"),
+    },
+    "search": {
+        "user": rate_from_env("QUOTA_SEARCH_USER", "5/60"),
+        "guild": rate_from_env("QUOTA_SEARCH_GUILD", "30/60"),
+    },
+}
+
+REJECTIONS = registry.counter("quota_rejections_total", "Commands refused because a quota bucket was empty")
+
+
+class Bucket:
+    # 保存して再起動後も使えるように、時刻は time.time() で持つ
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, capacity, rate, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class Quotas:
+    def __init__(self, quotas=QUOTAS, path=QUOTA_FILE, persist=QUOTA_PERSIST):
+        self.quotas = quotas
+        self.path = path
+        self.persist = persist
+        self.buckets = OrderedDict() # {"chat:user:123": Bucket}  最近使ったものほど後ろ
+        self.task = None
+        if persist: self.load()
+
+    def start(self):
+        # 保存はコマンドの処理中ではなく、定期タスクでまとめて行う
+        if self.persist and self.task is None:
+            self.task = asyncio.create_task(self.save_loop())
+
+    async def save_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(QUOTA_SAVE_INTERVAL)
+            try:
+                # 中身の書き出しはイベントループ上で、ファイルへの書き込みはスレッドで
+                await loop.run_in_executor(None, self.write, self.snapshot())
+            except Exception as e:
+                print(f"⚠️ Quota: {self.path} に保存できませんでした: {e}")
+
+    def check(self, command, user_id, guild_id=None):
+        # 使えるなら1回分減らして 0 を、ダメなら何秒後に使えるかを返す
+        # （どれか1つでも足りなければ、どのバケツも減らさない）
+        self.start()
+        now = time.time()
+        targets = []
+        for scope, key in (("user", user_id), ("guild", guild_id)):
+            rate = self.quotas.get(command, {}).get(scope)
+            if rate is None or key is None: continue
+            capacity, seconds = rate
+            name = f"{command}:{scope}:{key}"
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = Bucket(float(capacity), now)
+                # 増えすぎたら一番長く使っていないものを捨てる（たいてい満タンに戻っている）
+                while len(self.buckets) > QUOTA_MAX_BUCKETS:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(name)
+            targets.append((scope, bucket, capacity, capacity / seconds))
+
+        wait = 0.0
+        for scope, bucket, capacity, rate in targets:
+            tokens = bucket.refill(capacity, rate, now)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+                REJECTIONS.inc(command=command, scope=scope)
+        if wait: return wait
+
+        for _, bucket, _, _ in targets:
+            bucket.tokens -= 1
+        return 0.0
+
+    def is_full(self, name, bucket, now):
+        command, scope, _ = name.split(":", 2)
+        rate = self.quotas.get(command, {}).get(scope)
+        if rate is None: return True
+        capacity, seconds = rate
+        return bucket.refill(capacity, capacity / seconds, now) >= capacity
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            # 保存した順（古い順）に並べ直して、LRUの順番も引き継ぐ
+            for name, (tokens, updated) in sorted(raw.items(), key=lambda item: item[1][1]):
+                self.buckets[name] = Bucket(tokens, updated)
+        except (OSError, ValueError, TypeError) as e:
+            print(f"⚠️ Quota: {self.path} を読み込めませんでした: {e}")
+
+    def snapshot(self):
+        # 満タンのバケツは保存しない（無いのと同じなので）
+        now = time.time()
+        return {name: [b.tokens, b.updated] for name, b in self.buckets.items() if not self.is_full(name, b, now)}
+
+    def write(self, data):
+        if not os.path.exists(os.path.dirname(self.path)): os.makedirs(os.path.dirname(self.path))
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.persist: self.save()
+
+
+class FairLimiter:
+    # 同時実行数の上限つきの入口。空きが無い時は人（key）ごとに列を作り、順番に1つずつ通す
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.queues = OrderedDict() # {key: deque[Future]}  先頭の人から順に通す
+
+    def waiting(self):
+        return sum(len(q) for q in self.queues.values())
+
+    async def acquire(self, key):
+        if self.active < self.limit and not self.queues:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠をもらった直後にキャンセルされたら、次の人に回す
+                self.release()
+            else:
+                queue = self.queues.get(key)
+                if queue and future in queue:
+                    queue.remove(future)
+                    if not queue: del self.queues[key]
+            raise
+
+    def release(self):
+        # 空いた枠は、次の人に直接渡す（その人は列の最後に回る）
+        while self.queues:
+            key, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            if queue: self.queues.move_to_end(key)
+            else: del self.queues[key]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+_quotas = None
+
+def get_quotas():
+    global _quotas
+    if _quotas is None:
+        _quotas = Quotas()
+    return _quotas
@@ -0,0 +1,107 @@
+import heapq
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from name_index import fold
+from llm import estimate_tokens
+
+# ------------------------------------------------------------------
+# /chat 用の参考データ検索（BM25）
+# マクロ・攻略ボードを単語ごとの転置インデックスにしておき、
+# 質問に関係ありそうなものだけを上位k件、トークン上限の範囲でプロンプトに入れる。
+# 日本語は分かち書きせず、かな漢字は2文字ずつ（1文字だけの時は1文字）、英数字は単語で区切る。
+# 検索は質問に出てくる単語の分だけ見るので、登録数が増えてもほぼ一定の時間で終わる。
+# ------------------------------------------------------------------
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "1500")) # 参考データに使うトークンの上限
+RAG_MIN_RATIO = float(os.getenv("RAG_MIN_RATIO", "0.3"))     # 1位のスコアのこの割合未満は入れない
+RAG_MAX_DF = 0.5 # 半分以上の文書に出てくる単語はほぼ点数にならないので見ない（「です」など）
+NAME_WEIGHT = 3 # 名前に出てくる単語は本文より重く見る
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"[0-9a-z]+|[ぁ-ヿ㐀-鿿豈-﫿]+")
+NAMESPACE_LABELS = {"macros": "マクロ", "strategies": "攻略ボード"}
+
+def tokenize(text):
+    tokens = []
+    for run in TOKEN_RE.findall(fold(text)):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    def __init__(self):
+        self.docs = {}                    # {(ns, 名前): (単語数, 出てくる単語)}
+        self.postings = defaultdict(dict) # {単語: {(ns, 名前): 出現回数}}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, ns, name, body=""):
+        doc_id = (ns, name)
+        self.remove(ns, name)
+        counts = Counter(tokenize(body))
+        for token in tokenize(name): counts[token] += NAME_WEIGHT
+        for token, tf in counts.items():
+            self.postings[token][doc_id] = tf
+        length = sum(counts.values())
+        self.docs[doc_id] = (length, tuple(counts))
+        self.total_length += length
+
+    def remove(self, ns, name):
+        doc_id = (ns, name)
+        entry = self.docs.pop(doc_id, None)
+        if entry is None: return
+        length, tokens = entry
+        self.total_length -= length
+        # 消す文書の単語だけ見る（全単語はなめない）
+        for token in tokens:
+            docs = self.postings[token]
+            del docs[doc_id]
+            if not docs: del self.postings[token]
+
+    def search(self, query, k=RAG_TOP_K):
+        # [(スコア, ns, 名前)] をスコアの高い順に返す
+        if not self.docs: return []
+        n = len(self.docs)
+        avg_length = self.total_length / n or 1
+        scores = defaultdict(float)
+        for token in set(tokenize(query)):
+            docs = self.postings.get(token)
+            if not docs or (n > 2 and len(docs) > n * RAG_MAX_DF): continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.docs[doc_id][0] / avg_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        if not scores: return []
+        ranked = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        cutoff = ranked[0][1] * RAG_MIN_RATIO
+        return [(score, ns, name) for (ns, name), score in ranked if score >= cutoff]
+
+
+def index_text(ns, value):
+    # 攻略ボードの中身はゲーム用のコードなので、名前だけで引く
+    return value if ns == "macros" else ""
+
+def build_reference(hits, data, budget=RAG_TOKEN_BUDGET):
+    # 【参考データ】の本文を作る（上限を超える分は入れない。1件目だけは切り詰めてでも入れる）
+    parts = []
+    used = 0
+    for _, ns, name in hits:
+        value = data.get(ns, {}).get(name)
+        if value is None: continue
+        entry = f"■ {NAMESPACE_LABELS.get(ns, ns)}「{name}」\n{value}"
+        cost = estimate_tokens(entry)
+        if used + cost > budget:
+            if parts: break
+            entry = entry[:budget]
+            cost = estimate_tokens(entry)
+        parts.append(entry)
+        used += cost
+    return "\n\n".join(parts)
@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import json
+import os
+import sqlite3
+import time
+import traceback
+
+# ------------------------------------------------------------------
+# 予定イベントのスケジューラー
+# 全イベントを1つのヒープ（期限が近い順）で管理して、待つタスクは1つだけ。
+# イベントはSQLiteにも保存するので、再起動しても続きから動く
+# （止まっている間に期限が来た分は起動直後に実行する）。
+# イベントはハンドラーが成功してから消す。失敗したら少し後でやり直す（再起動をまたいでも残る）。
+# ------------------------------------------------------------------
+SCHEDULE_DB = "data/schedule.db"
+RETRY_DELAY = 300  # 失敗したイベントをやり直すまでの秒数
+RETRY_LIMIT = 12   # これだけ続けて失敗したら諦めて消す
+
+class Scheduler:
+    def __init__(self, path=SCHEDULE_DB):
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, due REAL, kind TEXT, key TEXT, payload TEXT)")
+        self.db.commit()
+        self.heap = []       # [(期限, id, 種類, キー, 追加データ)]
+        self.live = set()    # 取り消されていないイベントのid（ヒープからは取り出す時に捨てる）
+        for job_id, due, kind, key, payload in self.db.execute("SELECT id, due, kind, key, payload FROM jobs"):
+            self.heap.append((due, job_id, kind, key, json.loads(payload)))
+            self.live.add(job_id)
+        heapq.heapify(self.heap)
+        self.handlers = {}   # {種類: async def handler(key, payload)}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.firing = set()  # 実行中のハンドラーのタスク（参照を持っておかないと途中で消えることがある）
+        self.failures = {}   # {イベントid: 続けて失敗した回数}
+
+    def __len__(self):
+        return len(self.live)
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def add(self, due, kind, key, payload=None):
+        cur = self.db.execute("INSERT INTO jobs (due, kind, key, payload) VALUES (?, ?, ?, ?)", (due, kind, key, json.dumps(payload)))
+        self.db.commit()
+        job = (due, cur.lastrowid, kind, key, payload)
+        heapq.heappush(self.heap, job)
+        self.live.add(job[1])
+        # 一番早いイベントが変わったら待ち時間を計算し直させる
+        if self.heap[0] is job: self.wakeup.set()
+
+    def cancel(self, key):
+        ids = [row[0] for row in self.db.execute("SELECT id FROM jobs WHERE key = ?", (key,))]
+        if not ids: return
+        self.db.execute("DELETE FROM jobs WHERE key = ?", (key,))
+        self.db.commit()
+        self.live.difference_update(ids)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            # 取り消し済みのものは捨てる
+            while self.heap and self.heap[0][1] not in self.live:
+                heapq.heappop(self.heap)
+
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            _, job_id, kind, key, payload = heapq.heappop(self.heap)
+            self.live.discard(job_id)
+            handler = self.handlers.get(kind)
+            if handler is None:
+                self.delete(job_id)
+                continue
+            # DBの行は成功するまで残す（実行中に落ちても、次の起動でもう一度実行される）
+            task = asyncio.create_task(self.fire(handler, job_id, kind, key, payload))
+            self.firing.add(task)
+            task.add_done_callback(self.firing.discard)
+
+    async def fire(self, handler, job_id, kind, key, payload):
+        try:
+            await handler(key, payload)
+        except Exception as e:
+            print(f"❌ Scheduler Error ({kind} {key}): {e}")
+            traceback.print_exc()
+            self.retry(job_id, kind, key, payload)
+        else:
+            self.delete(job_id)
+
+    def delete(self, job_id):
+        self.failures.pop(job_id, None)
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.db.commit()
+
+    def retry(self, job_id, kind, key, payload):
+        count = self.failures.get(job_id, 0) + 1
+        if count >= RETRY_LIMIT:
+            print(f"⚠️ Scheduler: {kind} {key} は{count}回失敗したので諦めます")
+            self.delete(job_id)
+            return
+        due = time.time() + RETRY_DELAY
+        cur = self.db.execute("UPDATE jobs SET due = ? WHERE id = ?", (due, job_id))
+        self.db.commit()
+        if cur.rowcount == 0: return # 実行中に取り消された
+        self.failures[job_id] = count
+        job = (due, job_id, kind, key, payload)
+        heapq.heappush(self.heap, job)
+        self.live.add(job_id)
+        if self.heap[0] is job: self.wakeup.set()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for task in list(self.firing): task.cancel()
+        self.db.close()
@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+
+# ------------------------------------------------------------------
+# /search 用のキャッシュ
+# 1段目: 検索結果 (正規化したクエリがキー)
+# 2段目: 要約結果 (クエリ + 検索結果のハッシュがキー)
+# 同じクエリが同時に来たら、実行中の1回の結果をみんなで待つ（single-flight）
+# ------------------------------------------------------------------
+SEARCH_CACHE_BACKEND = os.getenv("SEARCH_CACHE_BACKEND", "memory") # "memory" or "sqlite"
+SEARCH_CACHE_DB = "data/search_cache.db"
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+SEARCH_RESULT_TTL = float(os.getenv("SEARCH_RESULT_TTL", "21600"))   # 検索結果は6時間
+SEARCH_SUMMARY_TTL = float(os.getenv("SEARCH_SUMMARY_TTL", "21600")) # 要約も6時間
+
+def normalize_query(query):
+    # 全角/半角・大文字/小文字・空白の違いは同じクエリとみなす
+    query = unicodedata.normalize("NFKC", query).lower()
+    return " ".join(query.split())
+
+def results_digest(results):
+    raw = json.dumps(results, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    def __init__(self, max_size=SEARCH_CACHE_SIZE):
+        self.max_size = max_size
+        self.items = OrderedDict() # {key: (期限, 値)} 古い順
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None: return None
+        if item[0] < time.time():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, ttl):
+        self.items[key] = (time.time() + ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def close(self):
+        pass
+
+
+class SQLiteCache:
+    # 再起動しても残したい場合用（値はJSONで保存）
+    def __init__(self, path=SEARCH_CACHE_DB, max_size=SEARCH_CACHE_SIZE):
+        self.max_size = max_size
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)")
+        self.db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        self.db.commit()
+
+    def get(self, key):
+        now = time.time()
+        row = self.db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        if row[1] < now:
+            self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.db.commit()
+            return None
+        self.db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+        )
+        # 上限を超えたら最近使われていないものから消す
+        self.db.execute(
+            "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY used DESC LIMIT ?)",
+            (self.max_size,)
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class SingleFlight:
+    # 取得は呼び出した人とは別のタスクで行う
+    # （最初に呼んだ人がキャンセルされても、同じ結果を待っている他の人まで巻き込まない）
+    def __init__(self):
+        self.inflight = {} # {key: Task}
+
+    async def do(self, key, fetch):
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(fetch())
+            task.add_done_callback(lambda t: self.finished(key, t))
+        # 同じキーを取得中なら、その結果を待つだけ
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        if self.inflight.get(key) is task: del self.inflight[key]
+        # 誰も待っていない場合に "never retrieved" 警告が出ないようにする
+        if not task.cancelled(): task.exception()
+
+
+class SearchCache:
+    def __init__(self, backend=SEARCH_CACHE_BACKEND):
+        self.store = SQLiteCache() if backend == "sqlite" else MemoryCache()
+        self.flight = SingleFlight()
+
+    async def get_results(self, query, fetch):
+        # fetch: 検索を実行して結果のリストを返すコルーチン関数
+        key = "r:" + normalize_query(query)
+        cached = self.store.get(key)
+        if cached is not None: return cached
+
+        async def load():
+            results = await fetch()
+            if results: self.store.set(key, results, SEARCH_RESULT_TTL)
+            return results
+        return await self.flight.do(key, load)
+
+    async def get_summary(self, query, results, summarize):
+        # summarize: 要約文を返すコルーチン関数
+        key = f"s:{normalize_query(query)}:{results_digest(results)}"
+        cached = self.store.get(key)
+        if cached is not None: return cached
+
+        async def load():
+            summary = await summarize()
+            if summary: self.store.set(key, summary, SEARCH_SUMMARY_TTL)
+            return summary
+        return await self.flight.do(key, load)
+
+    def close(self):
+        self.store.close()
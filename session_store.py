@@ -0,0 +1,96 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from llm import estimate_tokens
+
+# ------------------------------------------------------------------
+# /chat の会話履歴ストア
+# よく話す人の履歴だけメモリに置いて（LRU + 放置時間で追い出し）、
+# 全員分はSQLiteに圧縮して保存する。再起動しても次の /chat で読み直せる。
+# ------------------------------------------------------------------
+SESSION_DB = "data/sessions.db"
+SESSION_MAX_LIVE = int(os.getenv("SESSION_MAX_LIVE", "200"))        # メモリに置く最大人数
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))     # これだけ話さなければメモリから外す(秒)
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "6000")) # 1人あたりの履歴の上限トークン
+SESSION_RETENTION = float(os.getenv("SESSION_RETENTION_DAYS", "30")) * 86400
+
+ROLE_CODES = {"user": "u", "model": "m"}
+ROLE_NAMES = {v: k for k, v in ROLE_CODES.items()}
+
+def encode_history(history):
+    # [(role, text), ...] -> 圧縮したJSON
+    raw = json.dumps([[ROLE_CODES[r], t] for r, t in history], ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(raw.encode("utf-8"))
+
+def decode_history(blob):
+    return [(ROLE_NAMES[r], t) for r, t in json.loads(zlib.decompress(blob).decode("utf-8"))]
+
+def to_contents(history):
+    # Gemini に渡す形式へ変換
+    return [{"role": r, "parts": [t]} for r, t in history]
+
+
+class SessionStore:
+    def __init__(self, path=SESSION_DB, max_live=SESSION_MAX_LIVE, idle_ttl=SESSION_IDLE_TTL, token_budget=SESSION_TOKEN_BUDGET):
+        self.max_live = max_live
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.live = OrderedDict() # {user_id: [history, 最終利用時刻]} 古い順
+
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, history BLOB, updated_at REAL)")
+        self.db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - SESSION_RETENTION,))
+        self.db.commit()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        entry = self.live.get(user_id)
+        if entry is None:
+            # メモリに無ければDBから読み直す
+            row = self.db.execute("SELECT history FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            entry = self.live[user_id] = [decode_history(row[0]) if row else [], now]
+        else:
+            entry[1] = now
+            self.live.move_to_end(user_id)
+        self.evict(now)
+        return list(entry[0])
+
+    def append(self, user_id, user_text, model_text):
+        history = self.get(user_id)
+        history += [("user", user_text), ("model", model_text)]
+        history = self.trim(history)
+        self.live[user_id][0] = history
+        self.db.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, history, updated_at) VALUES (?, ?, ?)",
+            (user_id, encode_history(history), time.time())
+        )
+        self.db.commit()
+
+    def reset(self, user_id):
+        self.live.pop(user_id, None)
+        self.db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+        self.db.commit()
+
+    def trim(self, history):
+        # 予算オーバーなら古いやり取り（user+modelの組）から捨てる
+        total = sum(estimate_tokens(t) for _, t in history)
+        while total > self.token_budget and len(history) > 2:
+            total -= estimate_tokens(history[0][1]) + estimate_tokens(history[1][1])
+            history = history[2:]
+        return history
+
+    def evict(self, now):
+        # DBには保存済みなので、メモリから外すだけでOK
+        while self.live:
+            user_id, (_, last_used) = next(iter(self.live.items()))
+            if len(self.live) > self.max_live or now - last_used > self.idle_ttl:
+                del self.live[user_id]
+            else:
+                break
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,117 @@
+import ast
+import os
+import time
+import discord
+from metrics import registry
+
+# ------------------------------------------------------------------
+# 起動プロファイル
+# 各Cogはモジュールに PROFILE を書いて「何が必要か」を宣言する。
+#   PROFILE = {
+#       "intents": ["guilds", "presences"],   # discord.Intents のフラグ名
+#       "member_cache": ["joined"],           # discord.MemberCacheFlags のフラグ名
+#       "max_messages": 0,                    # メッセージキャッシュの件数（0なら無し）
+#       "chunk_guilds": False,                # 起動時に全メンバーを取得するか
+#       "optional": True,                     # 特権intentを断られたら、このCogを外して起動し直す
+#   }
+# members / presences / message_content は特権intentで、Developer Portal の Bot 設定で
+# 有効にしていないと接続そのものを断られる（PrivilegedIntentsRequired）。
+# main.py はそれを合計して、必要最小限の設定でBotを作る。
+# PROFILE はソースから読むだけ（Cogを実行するのは load_extension の1回だけ）なので、
+# 値はリテラル（文字列・数値・リスト・dict など）で書くこと。
+# ------------------------------------------------------------------
+COGS_DIR = "cogs"
+PRIVILEGED_INTENTS = {"members", "presences", "message_content"}
+# 起動しないCog（カンマ区切り）。特権intentを断られた時は main.py がここに足して起動し直す
+DISABLED_EXTENSIONS = [name for name in os.getenv("DISABLED_EXTENSIONS", "").split(",") if name]
+
+STARTUP_SECONDS = registry.gauge("startup_seconds", "Seconds from process start to the first on_ready")
+EXTENSION_LOAD_SECONDS = registry.gauge("extension_load_seconds", "Seconds spent importing and setting up each extension")
+
+def discover_extensions(directory=COGS_DIR):
+    names = [f"{directory}.{f[:-3]}" for f in sorted(os.listdir(directory)) if f.endswith(".py")]
+    return [name for name in names if name not in DISABLED_EXTENSIONS]
+
+def optional_privileged(profiles):
+    # 特権intentを使っていて、無くても起動してよいCog
+    return [name for name, p in profiles.items() if p.get("optional") and PRIVILEGED_INTENTS & set(p.get("intents", []))]
+
+def read_profile(name):
+    # モジュールを実行せずに、ソースの PROFILE = {...} だけを取り出す
+    path = name.replace(".", os.sep) + ".py"
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "PROFILE" for t in node.targets):
+            return ast.literal_eval(node.value)
+    return {}
+
+def collect_profiles(extensions):
+    profiles = {}
+    for name in extensions:
+        try:
+            profiles[name] = read_profile(name)
+        except (OSError, SyntaxError, ValueError) as e:
+            # 読めないCogは load_extension の時にエラーを出すので、ここでは飛ばす
+            print(f"⚠️ Profile: {name} の PROFILE を読めませんでした: {e}")
+    return profiles
+
+def build_bot_options(profiles):
+    intents = discord.Intents.none()
+    member_cache = discord.MemberCacheFlags.none()
+    max_messages = 0
+    chunk_guilds = False
+    for profile in profiles.values():
+        for flag in profile.get("intents", []): setattr(intents, flag, True)
+        for flag in profile.get("member_cache", []): setattr(member_cache, flag, True)
+        max_messages = max(max_messages, profile.get("max_messages", 0))
+        chunk_guilds = chunk_guilds or profile.get("chunk_guilds", False)
+    return {
+        "intents": intents,
+        "member_cache_flags": member_cache,
+        "max_messages": max_messages or None,
+        "chunk_guilds_at_startup": chunk_guilds,
+    }
+
+async def load_extensions(bot, extensions, timings):
+    # 1つずつ順番に読み込む（import も各Cogの setup も途中で待つところが無いので、
+    # gather しても結局は順番に動く。順番に測った方が1つずつの時間が正確）
+    # timings: {拡張名: 秒} に読み込み（import + setup）の所要時間を記録する
+    loaded = []
+    for name in extensions:
+        started = time.perf_counter()
+        try:
+            await bot.load_extension(name)
+        except Exception as e:
+            print(f"⚠️ Failed to load {name}: {e}")
+            continue
+        timings[name] = time.perf_counter() - started
+        loaded.append(name)
+        EXTENSION_LOAD_SECONDS.set(timings[name], extension=name)
+    return loaded
+
+def print_timing_table(extensions, timings):
+    print(f"{'Extension':<24}{'load':>10}")
+    for name in extensions:
+        load = f"{timings[name] * 1000:.0f}ms" if name in timings else "失敗"
+        print(f"{name:<24}{load:>10}")
+
+def describe_options(options):
+    intents = [name for name, on in options["intents"] if on]
+    member_cache = [name for name, on in options["member_cache_flags"] if on]
+    print(f"⚙️ Intents: {', '.join(intents) or 'なし'}")
+    print(f"⚙️ Member cache: {', '.join(member_cache) or 'なし'} / Messages: {options['max_messages'] or 0} / Chunk: {options['chunk_guilds_at_startup']}")
+
+def rss_mb():
+    # 今のメモリ使用量 (Linuxなら /proc から、それ以外は最大値)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def report_footprint(bot):
+    members = sum(len(g.members) for g in bot.guilds)
+    messages = len(bot.cached_messages)
+    print(f"📊 Guilds: {len(bot.guilds)} / Cached members: {members} / Cached messages: {messages} / RSS: {rss_mb():.1f}MB")